@@ -0,0 +1,188 @@
+# run_benchmarks.py
+# time the main pipeline stages on synthetic sessions of several sizes,
+# save the results as JSON and compare them against an earlier run.
+#
+#   python benchmarks/run_benchmarks.py --sizes small medium --save results/mine.json
+#   python benchmarks/run_benchmarks.py --compare results/mine.json
+
+import os
+import io
+import gc
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rec_header_to_yaml import synthetic
+from rec_header_to_yaml.utils import locate_rec_header, copy_rec_header, read_xml
+from rec_header_to_yaml.metadata import NWBMetadataHelper, clear_probe_registry
+from rec_header_to_yaml.header_store import HeaderStore
+from rec_header_to_yaml.batch import build_drafts
+
+
+# session sizes: ntrodes x channels, epochs, packets per epoch, cohort sessions
+SIZES = {
+    'small': dict(num_ntrodes=32, channels_per_ntrode=4, num_epochs=4,
+                  num_packets=3000, num_animals=2, num_dates=2),
+    'medium': dict(num_ntrodes=128, channels_per_ntrode=4, num_epochs=8,
+                   num_packets=30000, num_animals=2, num_dates=4),
+    'large': dict(num_ntrodes=256, channels_per_ntrode=4, num_epochs=30,
+                  num_packets=300000, num_animals=4, num_dates=4),
+}
+
+DIO_ID = {'Din': {1: 'Poke1', 2: 'Poke2', 3: 'Poke3'},
+          'Dout': {1: 'Light1'}, 'index_offset': 1}
+PROBES_USED = [{'name': 'tetrode', 'device_type': 'tetrode_12.5', 'location': 'CA1'}]
+
+REGRESSION_THRESHOLD = 1.2 # flag cases that got >20% slower
+
+
+def _time(func, repeat):
+    ''' best-of-repeat wall time (seconds); output of func is discarded '''
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        with contextlib.redirect_stdout(io.StringIO()):
+            t_start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - t_start)
+    return min(times)
+
+
+def run_size(size_name, work_dir, repeat=3, workers=None, sparse=False):
+    size = dict(SIZES[size_name])
+    num_animals = size.pop('num_animals')
+    num_dates = size.pop('num_dates')
+    data_path = os.path.join(work_dir, size_name, 'data')
+    out_path = os.path.join(work_dir, size_name, 'out')
+    copy_path = os.path.join(work_dir, size_name, 'tmp')
+    sessions, probes_yml_dir = synthetic.make_cohort(
+        data_path, num_animals=num_animals, num_dates=num_dates,
+        sparse=sparse, **size)
+    helper_kwargs = dict(data_path=data_path, dio_id=DIO_ID,
+                         probes_used=PROBES_USED, probes_yml_dir=probes_yml_dir,
+                         copy_path=copy_path, experimenter_name='synthetic')
+    session = dict(helper_kwargs, **sessions[0])
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        helper = NWBMetadataHelper(**session)
+    rec_files = helper.find_files_with_extension('rec')
+    header_copy = copy_rec_header(rec_files[0], copy_path)
+
+    def locate_headers():
+        for rec_file in rec_files:
+            locate_rec_header(rec_file)
+
+    def draft_from_scratch():
+        # a fresh helper, probe registry and header store: nothing memoized
+        clear_probe_registry()
+        fresh_helper = NWBMetadataHelper(header_store=HeaderStore(), **session)
+        fresh_helper.write_metadata_draft(out_path)
+
+    def ntrodes_config():
+        # a fresh header store too, which keeps parsed sections per digest
+        helper.header_store = HeaderStore()
+        helper.invalidate_config_cache()
+        helper._get_ntrodes_config()
+
+    def cohort():
+        shutil.rmtree(out_path, ignore_errors=True)
+        build_drafts(sessions, helper_kwargs, out_path=out_path,
+                     max_workers=workers, talkative=False)
+
+    cases = [
+        ('locate_rec_header (all epochs)', locate_headers, repeat),
+        ('read_xml', lambda: read_xml(header_copy), repeat),
+        ('_get_ntrodes_config', ntrodes_config, repeat),
+        ('write_metadata_draft (fresh helper)', draft_from_scratch, repeat),
+        ('cohort ({} sessions)'.format(len(sessions)), cohort, 1),
+    ]
+    results = {}
+    for name, func, n in cases:
+        results[name] = _time(func, n)
+        print('  {:<40} {:>10.4f} s'.format(name, results[name]))
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    ''' print current / baseline ratios; returns the number of regressions '''
+    regressions = 0
+    print('{:<8} {:<40} {:>10} {:>10} {:>7}'.format(
+        'size', 'case', 'base (s)', 'now (s)', 'ratio'))
+    for size_name, cases in results['sizes'].items():
+        for name, t_now in cases.items():
+            t_base = baseline['sizes'].get(size_name, {}).get(name)
+            if t_base is None:
+                continue
+            ratio = t_now / t_base if t_base > 0 else float('inf')
+            flag = ' <-- slower' if ratio > threshold else ''
+            regressions += bool(flag)
+            print('{:<8} {:<40} {:>10.4f} {:>10.4f} {:>6.2f}x{}'.format(
+                size_name, name, t_base, t_now, ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='benchmark rec_header_to_yaml on synthetic sessions')
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'],
+                        choices=list(SIZES))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='best of this many runs per case')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='process pool size for the cohort run')
+    parser.add_argument('--sparse', action='store_true',
+                        help='write sparse .rec files (fast; no packet data on disk)')
+    parser.add_argument('--work-dir', default=None,
+                        help='where to generate sessions (default: a temporary directory)')
+    parser.add_argument('--save', default=None, help='write the results here (JSON)')
+    parser.add_argument('--compare', default=None,
+                        help='compare against results saved earlier with --save')
+    args = parser.parse_args(argv)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='rec_header_to_yaml_bench_')
+    results = {'commit': _git_commit(), 'python': platform.python_version(),
+               'platform': platform.platform(), 'repeat': args.repeat,
+               'sparse': args.sparse, 'sizes': {}}
+    try:
+        for size_name in args.sizes:
+            print('{}: {}'.format(size_name, SIZES[size_name]))
+            results['sizes'][size_name] = run_size(
+                size_name, work_dir, repeat=args.repeat, workers=args.workers,
+                sparse=args.sparse)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.save is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with io.open(args.save, 'w') as fh:
+            json.dump(results, fh, indent=2)
+        print('saved to {}'.format(args.save))
+    if args.compare is not None:
+        with io.open(args.compare, 'r') as fh:
+            baseline = json.load(fh)
+        print('compared to {} (commit {}):'.format(args.compare, baseline.get('commit')))
+        return 1 if compare(results, baseline) > 0 else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
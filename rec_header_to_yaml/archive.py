@@ -0,0 +1,156 @@
+# archive.py
+# read session files straight from .tar archives and compressed .rec files,
+# as streams (nothing is extracted to disk)
+#
+# a member of an archive is addressed as if the archive were a directory:
+#   /data/beans/raw/20190718.tar/20190718_beans_01_s1.rec
+
+import os
+import io
+import bz2
+import gzip
+import lzma
+import tarfile
+from contextlib import contextmanager
+
+from .instrument import record_read
+
+
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.xz', '.tar.bz2')
+COMPRESSION_OPENERS = {'.gz': gzip.open, '.xz': lzma.open, '.bz2': bz2.open}
+# only .rec files are read through a compressed stream
+COMPRESSED_REC_SUFFIXES = tuple('.rec' + ext for ext in COMPRESSION_OPENERS)
+
+# process-wide archive listings: abspath -> ((size, mtime_ns), members)
+_member_cache = {}
+
+
+def is_archive(path):
+    return str(path).endswith(ARCHIVE_SUFFIXES) and os.path.isfile(path)
+
+
+def split_archive_path(path):
+    '''
+    (archive path, member name) if path points into an archive,
+    else None (a plain file, or no such file)
+    '''
+    path = str(path)
+    if os.path.exists(path):
+        return None
+    for suffix in ARCHIVE_SUFFIXES:
+        start = 0
+        while True:
+            pos = path.find(suffix + os.sep, start)
+            if pos < 0:
+                break
+            archive = path[:pos + len(suffix)]
+            if os.path.isfile(archive):
+                return archive, path[pos + len(suffix) + 1:]
+            start = pos + 1
+    return None
+
+
+def strip_compression(filename):
+    ''' 'x.rec.gz' -> 'x.rec'; other names are returned unchanged '''
+    filename = str(filename)
+    if filename.endswith(COMPRESSED_REC_SUFFIXES):
+        return os.path.splitext(filename)[0]
+    return filename
+
+
+def is_plain_file(path):
+    ''' a regular, uncompressed file (that can be seeked in) '''
+    return split_archive_path(path) is None and strip_compression(path) == str(path)
+
+
+def _tar_mode(archive):
+    # plain tars: seek over member data; compressed: stream through it
+    return 'r:' if str(archive).endswith('.tar') else 'r|*'
+
+
+def _archive_key(archive):
+    st = os.stat(archive)
+    return os.path.abspath(archive), (st.st_size, st.st_mtime_ns)
+
+
+def list_archive_members(archive):
+    '''
+    regular file members of a tar archive, as {name: (size, mtime_ns)};
+    for a plain .tar only the member headers are read, but a compressed
+    tar is decompressed in full (there is no index to seek by), so
+    listings are cached per process, keyed by the archive's size and mtime
+    '''
+    key, signature = _archive_key(archive)
+    cached = _member_cache.get(key)
+    if cached is None or cached[0] != signature:
+        members = {}
+        num_members = 0
+        with tarfile.open(archive, _tar_mode(archive)) as tf:
+            for member in tf:
+                num_members += 1
+                if member.isfile():
+                    members[member.name] = (member.size, int(member.mtime * 1e9))
+        if _tar_mode(archive) == 'r:':
+            record_read(num_members * tarfile.BLOCKSIZE) # one header block each
+        else:
+            record_read(signature[0]) # all of it
+        cached = (signature, members)
+        _member_cache[key] = cached
+    return cached[1]
+
+
+def expand_archive(archive):
+    ''' member paths of an archive, in the archive/member notation '''
+    return [os.path.join(str(archive), name) for name in list_archive_members(archive)]
+
+
+def source_stat(path):
+    '''
+    (size, mtime_ns) of a file; for an archive member the archive's
+    (any change to the archive may change the member)
+    '''
+    archived = split_archive_path(path)
+    st = os.stat(path if archived is None else archived[0])
+    return st.st_size, st.st_mtime_ns
+
+
+def file_stat(path):
+    ''' (size, mtime_ns) of a file, or of the member itself (from the listing) '''
+    archived = split_archive_path(path)
+    if archived is None:
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+    return list_archive_members(archived[0])[archived[1]]
+
+
+@contextmanager
+def _maybe_decompressed(fh, name):
+    if strip_compression(name) == name:
+        yield fh
+    else:
+        with COMPRESSION_OPENERS[os.path.splitext(name)[1]](fh, 'rb') as dfh:
+            yield dfh
+
+
+@contextmanager
+def open_source(path):
+    '''
+    a binary, read-only stream of a file, a compressed .rec file or
+    an archive member; decompressed lazily, only as far as it is read
+    '''
+    path = str(path)
+    archived = split_archive_path(path)
+    if archived is None:
+        with io.open(path, 'rb') as fh, _maybe_decompressed(fh, path) as dfh:
+            yield dfh
+        return
+    archive, name = archived
+    # the archive is read up to the member, and no further
+    with tarfile.open(archive, _tar_mode(archive)) as tf:
+        for member in tf:
+            if member.name == name:
+                with tf.extractfile(member) as fh, _maybe_decompressed(fh, name) as dfh:
+                    yield dfh
+                return
+    raise FileNotFoundError('{} not found in {}'.format(name, archive))
+
@@ -0,0 +1,243 @@
+# batch.py
+
+import os
+import re
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .metadata import NWBMetadataHelper
+from .utils import read_yml
+from .inputs import collect_inputs, draft_is_current
+
+
+DATE_PATTERN = re.compile(r'^\d{8}$') # YYYYMMDD
+
+
+def discover_sessions(data_path, animals=None):
+    '''
+    find every <animal>/raw/<date>/ directory under data_path.
+    animals: optional list of animal names to restrict the search to.
+    returns a sorted list of {'animal_name', 'date'} dicts.
+    '''
+    sessions = []
+    with os.scandir(data_path) as animal_dirs:
+        for animal_dir in animal_dirs:
+            if not animal_dir.is_dir():
+                continue
+            if (animals is not None) and (animal_dir.name not in animals):
+                continue
+            raw_path = os.path.join(animal_dir.path, 'raw')
+            if not os.path.isdir(raw_path):
+                continue
+            with os.scandir(raw_path) as date_dirs:
+                for date_dir in date_dirs:
+                    if date_dir.is_dir() and DATE_PATTERN.match(date_dir.name):
+                        sessions.append({'animal_name': animal_dir.name,
+                                         'date': date_dir.name})
+    return sorted(sessions, key=lambda s: (s['animal_name'], s['date']))
+
+
+def read_manifest(manifest_path):
+    '''
+    a manifest is a YAML list of sessions, each a dict with
+    animal_name, date, and optionally any NWBMetadataHelper argument
+    that overrides the shared settings for that session.
+    (a dict with a 'sessions' key is also accepted.)
+    '''
+    manifest = read_yml(manifest_path)
+    if isinstance(manifest, dict):
+        manifest = manifest['sessions']
+    sessions = []
+    for entry in manifest:
+        session = dict(entry)
+        session['date'] = str(session['date'])
+        sessions.append(session)
+    return sessions
+
+
+def _build_one_draft(session, helper_kwargs, out_path, skip_existing,
+                     incremental=False, validate=False):
+    ''' build a helper and write the draft for a single session '''
+    kwargs = dict(helper_kwargs)
+    kwargs.update(session)
+    session_id = '{}_{}'.format(kwargs['animal_name'], kwargs['date'])
+    result = {'session_id': session_id, 'status': 'ok',
+              'out_file': None, 'error': None, 'timing': None, 'validation': None}
+    t_start = time.time()
+    try:
+        out_file = os.path.join(out_path, session_id + '_metadata_draft.yml')
+        rec_path = os.path.join(kwargs['data_path'],
+                                '{}/raw/{}/'.format(kwargs['animal_name'], kwargs['date']))
+        exists = skip_existing and os.path.isfile(out_file)
+        inputs = None # one snapshot, for the check and the draft's record
+        if incremental and not exists:
+            init_args = NWBMetadataHelper.session_args(**kwargs)
+            inputs = collect_inputs(rec_path, init_args)
+        if exists:
+            result['status'] = 'skipped'
+            result['error'] = 'draft exists'
+        elif incremental and draft_is_current(out_path, session_id, rec_path,
+                                              init_args, current=inputs):
+            result['status'] = 'skipped'
+            result['error'] = 'up to date'
+        else:
+            helper = NWBMetadataHelper(**kwargs)
+            # (asks the helper's file index, which the draft then reuses)
+            if len(helper.find_files_with_extension('.rec')) == 0:
+                result['status'] = 'skipped'
+                result['error'] = 'no .rec files'
+            else:
+                result['out_file'] = helper.write_metadata_draft(out_path=out_path,
+                                                                 inputs=inputs)
+                if validate:
+                    # only the files that did not pass
+                    result['validation'] = [
+                        {k: res[k] for k in ['path', 'verdict', 'messages']}
+                        for res in helper.validate_rec_files(talkative=False)
+                        if res['verdict'] != 'pass']
+                result['timing'] = helper.get_timing_report()
+    except Exception as e: # report per session, keep going
+        result['status'] = 'failed'
+        result['error'] = repr(e)
+    result['elapsed'] = time.time() - t_start
+    return result
+
+
+def build_drafts(sessions, helper_kwargs, out_path='yaml/', max_workers=None,
+                 skip_existing=False, incremental=False, validate=False,
+                 talkative=True):
+    '''
+    write metadata drafts for many sessions over a process pool.
+
+    sessions: list of dicts with animal_name and date
+        (see discover_sessions, read_manifest); extra keys override
+        helper_kwargs for that session.
+    helper_kwargs: NWBMetadataHelper arguments shared by all sessions
+        (data_path, dio_id, probes_used, ...)
+    max_workers: size of the process pool (None: number of CPUs;
+        1 runs serially in this process)
+    incremental: skip sessions whose recorded draft inputs still match
+        (see inputs.draft_is_current)
+    validate: also check the .rec files of every drafted session against
+        their packet layout (see NWBMetadataHelper.validate_rec_files)
+    returns a list of per-session results (in input order):
+        {'session_id', 'status', 'out_file', 'error', 'elapsed', 'timing',
+         'validation'}
+        where status is 'ok', 'failed' or 'skipped', timing is the
+        helper's per-stage report (with instrument=True in helper_kwargs)
+        and validation lists the .rec files that did not pass
+        ({'path', 'verdict', 'messages'}; None if not validated)
+    '''
+    results = [None] * len(sessions)
+    if max_workers == 1:
+        for i, session in enumerate(sessions):
+            results[i] = _build_one_draft(session, helper_kwargs, out_path,
+                                          skip_existing, incremental, validate)
+            _report_session(results[i], results, talkative)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(_build_one_draft, session, helper_kwargs,
+                                   out_path, skip_existing, incremental,
+                                   validate): i
+                       for i, session in enumerate(sessions)}
+            for future in as_completed(futures):
+                i = futures[future]
+                results[i] = future.result()
+                _report_session(results[i], results, talkative)
+    if talkative:
+        print_batch_summary(results)
+    return results
+
+
+def _num_failed_files(result):
+    return sum([1 for res in result['validation'] or [] if res['verdict'] == 'fail'])
+
+
+def _report_session(result, results, talkative):
+    if not talkative and result['status'] != 'failed' and _num_failed_files(result) == 0:
+        return
+    num_done = sum([1 for res in results if res is not None])
+    print('[{}/{}] {}: {} ({:.1f} s){}'.format(
+        num_done, len(results), result['session_id'], result['status'],
+        result['elapsed'],
+        '' if result['error'] is None else ' - ' + result['error']))
+    for res in result['validation'] or []:
+        print('  {}: {} - {}'.format(os.path.basename(res['path']), res['verdict'],
+                                     '; '.join(res['messages'])))
+
+
+def print_batch_summary(results):
+    for status in ['ok', 'skipped', 'failed']:
+        session_ids = [res['session_id'] for res in results
+                       if res['status'] == status]
+        print('{}: {}'.format(status, len(session_ids)))
+        if status != 'ok':
+            for session_id in session_ids:
+                print('  - {}'.format(session_id))
+    invalid = [res['session_id'] for res in results if _num_failed_files(res) > 0]
+    if len(invalid) > 0:
+        print('with .rec files that failed validation: {}'.format(len(invalid)))
+        for session_id in invalid:
+            print('  - {}'.format(session_id))
+
+
+# --- console entry point
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='write metadata drafts for many sessions in parallel.')
+    parser.add_argument('config',
+        help=('YAML file with the shared NWBMetadataHelper arguments '
+              '(data_path, dio_id, probes_used, probes_yml_dir, ...)'))
+    parser.add_argument('--manifest',
+        help='YAML list of sessions (default: discover all under data_path)')
+    parser.add_argument('--data-path', help='overrides data_path in config')
+    parser.add_argument('--animal', action='append',
+        help='only discover sessions of this animal (repeatable)')
+    parser.add_argument('--out-path', default='yaml/')
+    parser.add_argument('--workers', type=int, default=None,
+        help='process pool size (default: number of CPUs)')
+    parser.add_argument('--skip-existing', action='store_true',
+        help='skip sessions that already have a draft in out-path')
+    parser.add_argument('--incremental', action='store_true',
+        help='skip sessions whose inputs have not changed since their draft')
+    parser.add_argument('--validate', action='store_true',
+        help=('also check every drafted .rec file against its packet layout '
+              '(reads a few packets per file)'))
+    parser.add_argument('--instrument', action='store_true',
+        help='record time and I/O per stage for every session')
+    parser.add_argument('--catalog',
+        help='also record every drafted session in this SQLite catalog')
+    parser.add_argument('--summary-json',
+        help='also write the per-session results (and timing) to this file')
+    args = parser.parse_args(argv)
+
+    helper_kwargs = read_yml(args.config)
+    if args.data_path is not None:
+        helper_kwargs['data_path'] = args.data_path
+    if args.instrument:
+        helper_kwargs['instrument'] = True
+    if args.catalog is not None:
+        helper_kwargs['catalog'] = args.catalog
+    if args.manifest is not None:
+        sessions = read_manifest(args.manifest)
+    else:
+        sessions = discover_sessions(helper_kwargs['data_path'],
+                                     animals=args.animal)
+    results = build_drafts(sessions, helper_kwargs, out_path=args.out_path,
+                           max_workers=args.workers,
+                           skip_existing=args.skip_existing,
+                           incremental=args.incremental,
+                           validate=args.validate)
+    if args.summary_json is not None:
+        with open(args.summary_json, 'w') as fh:
+            json.dump(results, fh, indent=1)
+    num_failed = sum([1 for res in results
+                      if res['status'] == 'failed' or _num_failed_files(res) > 0])
+    return 1 if num_failed > 0 else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
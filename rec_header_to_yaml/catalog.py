@@ -0,0 +1,204 @@
+# catalog.py
+# optional SQLite catalog of sessions, files, header digests and
+# electrode assignments, filled in by the pipeline as it runs
+
+import os
+import time
+import sqlite3
+
+from .utils import header_digest
+from .instrument import record_read
+from .archive import file_stat, open_source, strip_compression
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    animal_name TEXT NOT NULL,
+    date TEXT NOT NULL,
+    rec_path TEXT NOT NULL,
+    header_file TEXT,
+    header_digest TEXT,
+    num_ntrodes INTEGER,
+    num_channels INTEGER,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    date TEXT,
+    animal TEXT,
+    epoch INTEGER,
+    label TEXT,
+    extension TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    header_digest TEXT
+);
+CREATE TABLE IF NOT EXISTS ntrodes (
+    session_id TEXT NOT NULL,
+    ntrode_id INTEGER NOT NULL,
+    num_channels INTEGER,
+    electrode_group INTEGER,
+    shank INTEGER,
+    PRIMARY KEY (session_id, ntrode_id)
+);
+CREATE TABLE IF NOT EXISTS electrode_groups (
+    session_id TEXT NOT NULL,
+    group_id INTEGER NOT NULL,
+    device_type TEXT,
+    probe_name TEXT,
+    probe_cnt INTEGER,
+    location TEXT,
+    PRIMARY KEY (session_id, group_id)
+);
+CREATE INDEX IF NOT EXISTS sessions_animal_date ON sessions (animal_name, date);
+CREATE INDEX IF NOT EXISTS sessions_header_digest ON sessions (header_digest);
+CREATE INDEX IF NOT EXISTS files_session ON files (session_id, epoch);
+CREATE INDEX IF NOT EXISTS files_extension ON files (extension);
+CREATE INDEX IF NOT EXISTS files_header_digest ON files (header_digest);
+CREATE INDEX IF NOT EXISTS ntrodes_num_channels ON ntrodes (num_channels);
+CREATE INDEX IF NOT EXISTS electrode_groups_device_type ON electrode_groups (device_type);
+'''
+
+
+class Catalog():
+    '''
+    an SQLite file with one row per session, per file (with its parsed
+    filename components, size, mtime and header digest; the extension
+    of a compressed .rec file is 'rec'), per ntrode
+    (channel count, electrode group, shank) and per electrode group.
+    all paths are recorded absolute, whatever the working directory.
+    a session's rows are replaced as a whole each time it is recorded.
+
+    safe to share between processes: each opens its own connection,
+    and writes wait (up to timeout seconds) for the database lock.
+    '''
+
+    def __init__(self, db_path, timeout=60):
+        self.db_path = db_path
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(db_dir, exist_ok=True)
+        self.connection = sqlite3.connect(db_path, timeout=timeout)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # --- recording
+
+    def record_files(self, helper, header_digests=None):
+        '''
+        the files of a session (as indexed by helper), with their parsed
+        filename components; header_digests: {rec file: digest} if known
+        '''
+        header_digests = {os.path.abspath(path): digest
+                          for path, digest in (header_digests or {}).items()}
+        parsed = helper.parse_filenames(helper.list_files())
+        num_files = len(parsed['path'])
+        columns = [parsed.get(k, [None] * num_files)
+                   for k in ['date', 'animal', 'epoch', 'label', 'extension']]
+        rows = []
+        for path, (date, animal, epoch, label, extension) in zip(parsed['path'],
+                                                                 zip(*columns)):
+            size, mtime_ns = file_stat(path)
+            if extension is not None and strip_compression(path) != str(path):
+                extension = os.path.splitext(extension)[0] # 'rec.gz' -> 'rec'
+            rows.append((os.path.abspath(path), helper.session_id, date, animal,
+                         int(epoch) if (epoch or '').isdigit() else None,
+                         label, extension, size, mtime_ns,
+                         header_digests.get(os.path.abspath(path))))
+        with self.connection:
+            self.connection.execute('DELETE FROM files WHERE session_id = ?',
+                                    (helper.session_id,))
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def record_session(self, helper):
+        '''
+        everything about a session: its files, header digest, ntrodes
+        and electrode groups (reads what the helper has not computed yet)
+        '''
+        header_file = str(helper.header_file)
+        if strip_compression(header_file).endswith('.rec'):
+            digest = helper.header_store.add(header_file)
+        else:
+            with open_source(header_file) as fh:
+                header_bytes = fh.read()
+            record_read(len(header_bytes))
+            digest = header_digest(header_bytes)
+        ntrode_table = helper.ntrode_table
+        ntrode_rows = [(helper.session_id, entry['ntrode_id'], entry['num_channels'],
+                        entry['group'], entry['shank'])
+                       for entry in helper.probe_assignment_report]
+        group_rows = [(helper.session_id, group['id'], group['device_type'],
+                       group['probe'].get('name'), group['probe_cnt'],
+                       group['probe'].get('location'))
+                      for group in helper.electrode_groups]
+        self.record_files(helper, header_digests=helper.rec_header_digests)
+        with self.connection:
+            for table in ['ntrodes', 'electrode_groups']:
+                self.connection.execute(
+                    'DELETE FROM {} WHERE session_id = ?'.format(table),
+                    (helper.session_id,))
+            self.connection.execute(
+                'INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (helper.session_id, helper.animal_name, helper.date,
+                 os.path.abspath(helper.rec_path), os.path.abspath(header_file),
+                 digest, len(ntrode_table),
+                 len(ntrode_table.hw_chan), time.time()))
+            self.connection.executemany(
+                'INSERT INTO ntrodes VALUES (?, ?, ?, ?, ?)', ntrode_rows)
+            self.connection.executemany(
+                'INSERT INTO electrode_groups VALUES (?, ?, ?, ?, ?, ?)', group_rows)
+
+    def remove_session(self, session_id):
+        with self.connection:
+            for table in ['sessions', 'files', 'ntrodes', 'electrode_groups']:
+                self.connection.execute(
+                    'DELETE FROM {} WHERE session_id = ?'.format(table), (session_id,))
+
+    # --- queries
+
+    def query(self, sql, params=()):
+        ''' rows of any SQL query, as dicts '''
+        return [dict(row) for row in self.connection.execute(sql, params)]
+
+    def sessions(self, animal_name=None):
+        if animal_name is None:
+            return self.query('SELECT * FROM sessions ORDER BY animal_name, date')
+        return self.query('SELECT * FROM sessions WHERE animal_name = ? ORDER BY date',
+                          (animal_name,))
+
+    def sessions_with_probe(self, device_type):
+        ''' sessions with at least one electrode group of this probe type '''
+        return self.query(
+            'SELECT DISTINCT s.* FROM sessions s '
+            'JOIN electrode_groups g ON g.session_id = s.session_id '
+            'WHERE g.device_type = ? ORDER BY s.animal_name, s.date', (device_type,))
+
+    def epochs_with_ntrode_channels(self, num_channels):
+        '''
+        (session_id, epoch) of the .rec files with an ntrode of num_channels
+        channels (ntrodes are recorded from the session's majority header,
+        so .rec files known to have a different header are left out)
+        '''
+        return self.query(
+            'SELECT DISTINCT f.session_id, f.epoch FROM files f '
+            'JOIN sessions s ON s.session_id = f.session_id '
+            'JOIN ntrodes n ON n.session_id = f.session_id '
+            'WHERE n.num_channels = ? AND f.extension = ? '
+            'AND (f.header_digest IS NULL OR f.header_digest = s.header_digest) '
+            'ORDER BY f.session_id, f.epoch', (num_channels, 'rec'))
+
+    def sessions_with_header(self, digest):
+        return self.query('SELECT * FROM sessions WHERE header_digest = ? '
+                          'ORDER BY animal_name, date', (digest,))
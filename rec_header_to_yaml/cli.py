@@ -0,0 +1,128 @@
+# cli.py
+# rec-header-to-yaml: single-session console command.
+# only argparse is imported at module load; each subcommand imports what
+# it needs (parse, xmltodict, yaml, ...), so --help starts fast.
+
+import sys
+import argparse
+
+
+def _add_session_args(parser):
+    parser.add_argument('animal_name')
+    parser.add_argument('date', help='YYYYMMDD')
+    parser.add_argument('--config',
+        help=('YAML file with NWBMetadataHelper arguments '
+              '(data_path, dio_id, probes_used, probes_yml_dir, ...)'))
+    parser.add_argument('--data-path', help='overrides data_path in config')
+    parser.add_argument('--copy-path', help='overrides copy_path in config')
+    parser.add_argument('--catalog', help='record the session in this SQLite catalog')
+
+
+def _build_helper(args, **overrides):
+    from .metadata import NWBMetadataHelper
+
+    helper_kwargs = {'dio_id': {}, 'probes_used': []}
+    if args.config is not None:
+        from .utils import read_yml
+        helper_kwargs.update(read_yml(args.config))
+    if args.data_path is not None:
+        helper_kwargs['data_path'] = args.data_path
+    if args.copy_path is not None:
+        helper_kwargs['copy_path'] = args.copy_path
+    if args.catalog is not None:
+        helper_kwargs['catalog'] = args.catalog
+    if 'data_path' not in helper_kwargs:
+        raise SystemExit('error: no data_path (use --data-path or --config)')
+    helper_kwargs.update(overrides)
+    helper_kwargs.update(animal_name=args.animal_name, date=str(args.date))
+    return NWBMetadataHelper(**helper_kwargs)
+
+
+def extract_headers(args):
+    helper = _build_helper(args)
+    summary = helper.extract_rec_headers(max_workers=args.workers,
+                                         use_processes=args.use_processes,
+                                         talkative=not args.quiet)
+    return 1 if any(res['status'] != 'ok' for res in summary) else 0
+
+
+def draft(args):
+    helper = _build_helper(args, instrument=args.instrument)
+    inputs = None
+    if args.incremental:
+        from .inputs import collect_inputs, draft_is_current
+        # (one snapshot, for the check and the draft's record)
+        inputs = collect_inputs(helper.rec_path, helper.init_args)
+        if draft_is_current(args.out_path, helper.session_id, helper.rec_path,
+                            helper.init_args, current=inputs):
+            print('{}: draft is current, skipped.'.format(helper.session_id))
+            return 0
+    helper.write_metadata_draft(out_path=args.out_path, inputs=inputs)
+    if args.instrument:
+        helper.instrumentation.print_report()
+    return 0
+
+
+def validate(args):
+    helper = _build_helper(args)
+    results = helper.validate_rec_files(num_checks=args.checks)
+    return 1 if any(res['verdict'] == 'fail' for res in results) else 0
+
+
+def list_tasks(args):
+    helper = _build_helper(args)
+    for task in helper.detected_tasks:
+        task_name = helper.task_code.get(task, helper.placeholder_text)
+        epochs = [int(t[0]) for t in helper.epoch_label_tuples if t[1] == task]
+        print('{} ({}): epochs {}'.format(
+            task_name, task, ', '.join([str(e) for e in epochs])))
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='rec-header-to-yaml',
+        description='draft metadata YAML from the .rec files of a session.')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+
+    sub = subparsers.add_parser('extract-headers',
+        help='copy the distinct .rec headers of a session into copy_path')
+    _add_session_args(sub)
+    sub.add_argument('--workers', type=int, default=1,
+        help='concurrent extractions (default: 1)')
+    sub.add_argument('--use-processes', action='store_true',
+        help='use a process pool instead of threads')
+    sub.add_argument('--quiet', action='store_true')
+    sub.set_defaults(func=extract_headers)
+
+    sub = subparsers.add_parser('draft',
+        help='write the metadata draft of a session')
+    _add_session_args(sub)
+    sub.add_argument('--out-path', default='yaml/')
+    sub.add_argument('--incremental', action='store_true',
+        help='do nothing if the inputs have not changed since the last draft')
+    sub.add_argument('--instrument', action='store_true',
+        help='print time and I/O per stage')
+    sub.set_defaults(func=draft)
+
+    sub = subparsers.add_parser('validate',
+        help='check the .rec files of a session against their packet layout')
+    _add_session_args(sub)
+    sub.add_argument('--checks', type=int, default=8,
+        help='strided packets to sample per file (0: size check only; default: 8)')
+    sub.set_defaults(func=validate)
+
+    sub = subparsers.add_parser('list-tasks',
+        help='list the tasks and epochs found in the session file names')
+    _add_session_args(sub)
+    sub.set_defaults(func=list_tasks)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
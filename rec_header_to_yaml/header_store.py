@@ -0,0 +1,171 @@
+# header_store.py
+# content-addressed store of .rec headers: identical configs are kept
+# (and parsed) once, however many epochs / sessions share them
+
+import os
+import io
+import json
+import threading
+from collections import Counter
+
+from .instrument import record_read, record_write
+from .archive import source_stat
+from .utils import (locate_rec_header, header_digest, parse_xml_bytes,
+                    stream_header_sections, write_text_atomic)
+
+
+def read_header_entry(rec_path):
+    '''
+    (abspath, [size, mtime_ns, digest, data_offset], header bytes) of a
+    .rec file, as kept in a HeaderStore (a plain function, so that it
+    can run in a worker process)
+    '''
+    key = os.path.abspath(rec_path)
+    size, mtime_ns = source_stat(key) # (an archive member: the archive's)
+    header_bytes, data_offset = locate_rec_header(key)
+    return key, [size, mtime_ns, header_digest(header_bytes), data_offset], header_bytes
+
+
+def write_header_file(store_dir, digest, header_bytes):
+    ''' <store_dir>/<digest>.xml, written only if it is not there yet '''
+    header_path = os.path.join(store_dir, digest + '.xml')
+    if not os.path.isfile(header_path):
+        os.makedirs(store_dir, exist_ok=True)
+        # (concurrent writers of the same digest each use their own tmp file)
+        tmp_path = '{}.{}.{}.tmp'.format(header_path, os.getpid(), threading.get_ident())
+        with io.open(tmp_path, 'wb') as fh:
+            fh.write(header_bytes)
+        record_write(len(header_bytes))
+        os.replace(tmp_path, header_path)
+    return header_path
+
+
+class HeaderStore():
+    '''
+    maps each .rec file to the digest of its normalized header
+    (see utils.header_digest), and each digest to the header bytes,
+    parsed once on demand.
+
+    store_dir: if given, headers are kept there as <digest>.xml and the
+        file -> digest index as index.json, so the store persists across
+        runs (and is shared by every helper pointing to it).
+    '''
+
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, store_dir=None):
+        self.store_dir = store_dir
+        self._file_index = {} # abspath -> [size, mtime_ns, digest, data_offset]
+        self._headers = {} # digest -> header bytes
+        self._configs = {} # digest -> parsed config (full tree)
+        self._sections = {} # digest -> stream_header_sections records
+        self._index_changed = False
+        if store_dir is not None:
+            os.makedirs(store_dir, exist_ok=True)
+            self._load_index()
+
+    def lookup(self, rec_path):
+        ''' the header digest of rec_path if known and unchanged, else None '''
+        key = os.path.abspath(rec_path)
+        entry = self._file_index.get(key)
+        if (entry is not None) and entry[:2] == list(source_stat(key)):
+            return entry[2]
+        return None
+
+    def add(self, rec_path):
+        ''' returns the header digest of rec_path (re-read only if it changed) '''
+        digest = self.lookup(rec_path)
+        if digest is None:
+            key, entry, header_bytes = read_header_entry(rec_path)
+            self.add_entry(key, entry, header_bytes)
+            digest = entry[2]
+        return digest
+
+    def add_entry(self, key, entry, header_bytes):
+        ''' an entry read by read_header_entry (e.g. in a worker) '''
+        digest = entry[2]
+        if digest not in self._headers:
+            self._headers[digest] = header_bytes
+            self._write_header(digest, header_bytes)
+        self._file_index[key] = entry
+        self._index_changed = True
+
+    def get_data_offset(self, rec_path):
+        ''' byte offset where the binary data of rec_path starts '''
+        self.add(rec_path)
+        return self._file_index[os.path.abspath(rec_path)][3]
+
+    def add_files(self, rec_paths):
+        ''' returns {rec_path: digest} '''
+        digests = {rec_path: self.add(rec_path) for rec_path in rec_paths}
+        self.save()
+        return digests
+
+    def get_header_bytes(self, digest):
+        if digest not in self._headers:
+            with io.open(self._header_path(digest), 'rb') as fh:
+                self._headers[digest] = fh.read()
+            record_read(len(self._headers[digest]))
+        return self._headers[digest]
+
+    def get_config(self, digest):
+        ''' full-tree parse, once per digest (shared; treat as read-only) '''
+        if digest not in self._configs:
+            xml_data = parse_xml_bytes(self.get_header_bytes(digest))
+            self._configs[digest] = xml_data['Configuration']
+        return self._configs[digest]
+
+    def get_sections(self, digest):
+        ''' streaming parse of the sections we use, once per digest '''
+        if digest not in self._sections:
+            self._sections[digest] = stream_header_sections(
+                self.get_header_bytes(digest))
+        return self._sections[digest]
+
+    @staticmethod
+    def group_by_digest(file_digests):
+        '''
+        file_digests: {rec_path: digest}
+        returns (majority_digest, outliers) where outliers is a sorted list
+        of the files whose header differs from the most common one
+        '''
+        if len(file_digests) == 0:
+            return None, []
+        counts = Counter(file_digests.values())
+        majority_digest = counts.most_common(1)[0][0]
+        outliers = sorted([rec_path for rec_path, digest in file_digests.items()
+                           if digest != majority_digest])
+        return majority_digest, outliers
+
+    # --- persistence
+
+    def _header_path(self, digest):
+        if self.store_dir is None:
+            raise KeyError('unknown header digest {}'.format(digest))
+        return os.path.join(self.store_dir, digest + '.xml')
+
+    def _write_header(self, digest, header_bytes):
+        if self.store_dir is not None:
+            write_header_file(self.store_dir, digest, header_bytes)
+
+    def _load_index(self):
+        index_path = os.path.join(self.store_dir, self.INDEX_FILE)
+        try:
+            record_read(os.path.getsize(index_path))
+            with io.open(index_path, 'r') as fh:
+                file_index = json.load(fh)
+        except (OSError, ValueError):
+            file_index = {}
+        self._file_index = file_index
+
+    def save(self):
+        ''' write the file -> digest index (if persistent and changed) '''
+        if self.store_dir is None or not self._index_changed:
+            return
+        # merge with entries other processes may have added meanwhile
+        file_index = self._file_index
+        self._load_index()
+        self._file_index.update(file_index)
+        write_text_atomic(os.path.join(self.store_dir, self.INDEX_FILE),
+                          json.dumps(self._file_index, sort_keys=True))
+        self._index_changed = False
@@ -0,0 +1,120 @@
+# inputs.py
+# record what a metadata draft was built from, to skip unchanged sessions
+
+import os
+import io
+import json
+import hashlib
+
+from .instrument import record_read
+from .utils import scan_directory, write_text_atomic
+
+
+INPUTS_VERSION = 1 # bump when the draft layout changes
+INPUTS_SUFFIX = '_metadata_draft.inputs.json'
+# constructor args that don't affect the draft
+EXCLUDED_ARGS = ['max_workers', 'header_store', 'instrument', 'catalog']
+
+
+def inputs_path(out_path, session_id):
+    return os.path.join(out_path, session_id + INPUTS_SUFFIX)
+
+
+def _file_stat(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _canonical(obj):
+    ''' JSON-compatible copy with string keys (e.g. for dio_id int keys) '''
+    if isinstance(obj, dict):
+        return {str(k): _canonical(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_canonical(v) for v in obj]
+    if isinstance(obj, (str, int, float, bool)) or obj is None:
+        return obj
+    return repr(obj)
+
+
+def args_digest(init_args):
+    args = {k: v for k, v in init_args.items() if k not in EXCLUDED_ARGS}
+    text = json.dumps(_canonical(args), sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def collect_inputs(rec_path, init_args):
+    '''
+    snapshot of the inputs of a draft (only stats files):
+    - every file under rec_path: size and mtime (by relative path)
+    - probe definition files and the reconfig file: size and mtime
+    - a digest of the constructor arguments
+    '''
+    files = {}
+    for file_path in sorted(scan_directory(rec_path)):
+        files[os.path.relpath(file_path, rec_path)] = _file_stat(file_path)
+
+    other_files = {}
+    probes_yml_dir = init_args.get('probes_yml_dir')
+    for prb in init_args.get('probes_used') or []:
+        probe_file = os.path.join(probes_yml_dir, prb['device_type'] + '.yml')
+        if os.path.isfile(probe_file):
+            other_files[os.path.abspath(probe_file)] = _file_stat(probe_file)
+    reconfig = init_args.get('reconfig')
+    if (reconfig is not None) and os.path.isfile(reconfig):
+        other_files[os.path.abspath(reconfig)] = _file_stat(reconfig)
+
+    inputs = {
+        'version': INPUTS_VERSION,
+        'args_digest': args_digest(init_args),
+        'files': files,
+        'other_files': other_files
+    }
+    return inputs
+
+
+def add_header_digests(inputs, rec_path, header_digests):
+    '''
+    record the header digests a draft was built from in its inputs
+    header_digests: {rec file: digest} (see NWBMetadataHelper.rec_header_digests)
+    '''
+    inputs['header_digests'] = {os.path.relpath(path, rec_path): digest
+                                for path, digest in sorted(header_digests.items())}
+    return inputs
+
+
+def write_inputs(path, inputs):
+    write_text_atomic(path, json.dumps(inputs, indent=1, sort_keys=True) + '\n')
+
+
+def read_inputs(path):
+    try:
+        record_read(os.path.getsize(path))
+        with io.open(path, 'r') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def inputs_match(recorded, current):
+    ''' compare everything except the header digests (that needs reading) '''
+    if recorded is None:
+        return False
+    keys = ['version', 'args_digest', 'files', 'other_files']
+    return all(recorded.get(k) == current.get(k) for k in keys)
+
+
+def draft_is_current(out_path, session_id, rec_path, init_args, current=None):
+    '''
+    True if the draft and its inputs record exist in out_path,
+    and nothing in the recorded inputs has changed since.
+    only stats files; no header is read.
+    current: the inputs as they are now, if already collected (see
+        collect_inputs; e.g. to pass on to write_metadata_draft after)
+    '''
+    draft_file = os.path.join(out_path, session_id + '_metadata_draft.yml')
+    if not os.path.isfile(draft_file):
+        return False
+    recorded = read_inputs(inputs_path(out_path, session_id))
+    if current is None:
+        current = collect_inputs(rec_path, init_args)
+    return inputs_match(recorded, current)
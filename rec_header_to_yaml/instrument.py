@@ -0,0 +1,89 @@
+# instrument.py
+# opt-in timing and I/O accounting, per stage
+
+import time
+import json
+import threading
+import contextvars
+from contextlib import contextmanager
+
+
+# the Instrumentation currently recording (if any)
+_active = contextvars.ContextVar('rec_header_to_yaml_instrumentation', default=None)
+
+
+class Instrumentation():
+    '''
+    records wall time, bytes read / written and files (or directories)
+    opened, per named stage. stages can nest; I/O is counted in every
+    enclosing stage, so numbers are inclusive.
+    I/O is counted by the functions in this package (see record_read,
+    record_write), for the thread that entered the stage and for threads
+    started in a copy of its context (contextvars.copy_context).
+    process pool workers are not counted.
+    '''
+
+    def __init__(self):
+        self.stages = {} # name -> counters (in order of first use)
+        self._stack = []
+        self._lock = threading.Lock() # worker threads add to the same stages
+
+    @contextmanager
+    def stage(self, name):
+        counters = self.stages.setdefault(name, {
+            'calls': 0, 'wall_time': 0.0,
+            'bytes_read': 0, 'bytes_written': 0, 'files_opened': 0})
+        counters['calls'] += 1
+        token = _active.set(self)
+        self._stack.append(name)
+        t_start = time.perf_counter()
+        try:
+            yield counters
+        finally:
+            counters['wall_time'] += time.perf_counter() - t_start
+            self._stack.pop()
+            _active.reset(token)
+
+    def _add(self, key, value):
+        with self._lock:
+            for name in set(self._stack):
+                self.stages[name][key] += value
+
+    def report(self):
+        ''' {stage: {'calls', 'wall_time', 'bytes_read', 'bytes_written', 'files_opened'}} '''
+        return {name: dict(counters) for name, counters in self.stages.items()}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.report(), **kwargs)
+
+    def print_report(self):
+        print('{:<48} {:>6} {:>10} {:>12} {:>12} {:>6}'.format(
+            'stage', 'calls', 'time (s)', 'read (B)', 'written (B)', 'opens'))
+        for name, c in self.stages.items():
+            print('{:<48} {:>6} {:>10.3f} {:>12} {:>12} {:>6}'.format(
+                name, c['calls'], c['wall_time'], c['bytes_read'],
+                c['bytes_written'], c['files_opened']))
+
+
+@contextmanager
+def maybe_stage(instrumentation, name):
+    ''' instrumentation.stage(name), or nothing if instrumentation is None '''
+    if instrumentation is None:
+        yield None
+    else:
+        with instrumentation.stage(name) as counters:
+            yield counters
+
+
+def record_read(num_bytes, opened=1):
+    instrumentation = _active.get()
+    if instrumentation is not None:
+        instrumentation._add('bytes_read', num_bytes)
+        instrumentation._add('files_opened', opened)
+
+
+def record_write(num_bytes, opened=1):
+    instrumentation = _active.get()
+    if instrumentation is not None:
+        instrumentation._add('bytes_written', num_bytes)
+        instrumentation._add('files_opened', opened)
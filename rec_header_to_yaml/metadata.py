@@ -4,10 +4,26 @@ import os
 import io
 from pathlib import Path
 import re
+import copy
+import time
+import inspect
+import contextvars
+import fnmatch
 import parse
 import warnings
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
-from .utils import copy_rec_header, read_xml, read_yml, append_yml
+from .utils import (read_xml, header_digest, rec_data_summary, validate_rec_data,
+                    stream_header_sections, read_hardware_attrs, scan_directory,
+                    read_yml, dump_yml, write_text_atomic)
+from .inputs import collect_inputs, add_header_digests, inputs_path, write_inputs
+from .header_store import HeaderStore, read_header_entry, write_header_file
+from .catalog import Catalog
+from .archive import (is_archive, expand_archive, is_plain_file, strip_compression,
+                      source_stat, open_source)
+from .ntrodes import NTrodeTable, ProbeAssigner
+from .instrument import Instrumentation, maybe_stage, record_read
+from .statescript import scan_dio_changes, header_dio_pins, cross_check_dio
 
 
 HOME_DIR = os.path.expanduser('~')
@@ -15,6 +31,60 @@ DEFAULT_TEMP_DIR = os.path.join(HOME_DIR, 'tmp/rec_header/')
 
 DEFAULT_PROBE_DIR = '../sample/yaml/'
 
+# process-wide probe registry: abspath -> (mtime, summary)
+_probe_registry = {}
+
+def load_probe_summary(probe_yml_path):
+    '''
+    read a probe definition once per process and keep only what we use;
+    re-read when the file's mtime changes.
+    returns a new dict with ch_per_probe, ch_per_shank, num_shanks,
+    description and units.
+    '''
+    key = os.path.abspath(probe_yml_path)
+    mtime = os.stat(key).st_mtime_ns
+    cached = _probe_registry.get(key)
+    if cached is None or cached[0] != mtime:
+        probe_yml = read_yml(key)
+        ch_cnts = [len(shank['electrodes']) for shank in probe_yml['shanks']]
+        if len(set(ch_cnts)) != 1:
+            raise RuntimeError('cannot parse probe with different sized shanks')
+        summary = {
+            'ch_per_probe': sum(ch_cnts),
+            'ch_per_shank': ch_cnts[0],
+            'num_shanks': probe_yml['num_shanks'],
+            'description': probe_yml['probe_description'],
+            'units': probe_yml['units']
+        }
+        cached = (mtime, summary)
+        _probe_registry[key] = cached
+    return dict(cached[1])
+
+def clear_probe_registry():
+    _probe_registry.clear()
+
+
+def _extract_one_header(rec_file, copy_dir):
+    '''
+    read a single rec header and, if copy_dir is given, write it there as
+    <digest>.xml (unless an identical header is there already), catching
+    errors into the summary; 'entry' and 'header_bytes' are for the HeaderStore
+    '''
+    result = {'rec_file': str(rec_file), 'header_file': None, 'digest': None,
+              'status': 'ok', 'error': None, 'entry': None, 'header_bytes': None}
+    t_start = time.time()
+    try:
+        key, entry, header_bytes = read_header_entry(rec_file)
+        if copy_dir is not None:
+            result['header_file'] = write_header_file(copy_dir, entry[2], header_bytes)
+        result.update(digest=entry[2], entry=(key, entry), header_bytes=header_bytes)
+    except Exception as e: # report per file, keep going
+        result['status'] = 'error'
+        result['error'] = repr(e)
+    result['elapsed'] = time.time() - t_start
+    return result
+
+
 class NWBMetadataHelper():
     ''' help collecting metadata.yaml from experimental output. '''
 
@@ -32,10 +102,21 @@ class NWBMetadataHelper():
                  subject_info: dict = dict(),
                  placeholder_text: str = 'Unknown',
                  copy_path: str = DEFAULT_TEMP_DIR,
+                 copy_header: bool = False,
                  reconfig=None,
                  task_code=None,
                  filename_format=None,
+                 max_workers=1,
+                 header_store=None,
+                 instrument=False,
+                 catalog=None,
                  **kwargs):
+        # all constructor arguments, recorded with the draft inputs
+        init_args = {k: v for k, v in locals().items() if k not in ('self', 'kwargs')}
+        self.init_args = self.session_args(**init_args, **kwargs)
+        # instrument: record time and I/O per stage (see get_timing_report)
+        self.instrumentation = Instrumentation() if instrument else None
+
         self.animal_name = animal_name
         self.date = date
         self.data_path = data_path
@@ -43,42 +124,149 @@ class NWBMetadataHelper():
         # (if the two are different)
         self.animal_nickname = animal_nickname or self.animal_name
         self.session_id = '{}_{}'.format(self.animal_name, self.date)
+        self._dir_index = {} # file lists by directory; see refresh()
         self.rec_path = os.path.join(self.data_path,
                             '{}/raw/{}/'.format(self.animal_name, self.date))
         self.copy_path = os.path.join(copy_path, self.session_id + '/')
+        self.copy_header = copy_header # write header copies (see extract_rec_headers)
+        self.max_workers = max_workers # for concurrent header reads (and extraction)
+        # header_store: a HeaderStore (can be shared between helpers),
+        # or a directory to persist one in (None: in memory only)
+        if not isinstance(header_store, HeaderStore):
+            header_store = HeaderStore(store_dir=header_store)
+        self.header_store = header_store
+        self.catalog = catalog # SQLite catalog file to record into (see catalog.py)
+        self._rec_header_digests = None # rec file -> header digest
+        self._header_outliers = None # rec files with a non-majority header
+        self._rec_summaries = None # see get_rec_file_summaries
+        self._dio_stats = None # see get_dio_stats
         
         self.dio_id = dio_id
-        self.probes_used = self.load_probe_metadata(probes_used, probes_yml_dir)
+        # everything below that reads files is done on first use
+        # (see the properties), so that constructing a helper is cheap
+        self._probes_used_arg = probes_used
+        self.probes_yml_dir = probes_yml_dir
+        self._probes_used = None
         
         self.placeholder_text = placeholder_text
 
         self.set_filename_format(filename_format=filename_format)
         self.task_code = task_code or {'r': 'run', 's': 'sleep'}
-        self._detect_tasks()
 
-        self.header_file = self._get_header_file(reconfig=reconfig)
-        self._get_ntrodes_config()
+        self._config_cache = {} # parsed header config, by (path, mtime)
+        self.reconfig = reconfig
+        self._header_file = None
+        self._ntrode_table = None # see _get_ntrodes_config
+        self._electrode_groups = None
+        self._probe_assignment_report = None
 
         self.set_basic_info(experimenter_name=experimenter_name,
                             experiment_description=experiment_description,
                             session_description=session_description,
                             **subject_info)
 
+    def _stage(self, name):
+        return maybe_stage(self.instrumentation, name)
+
+    def get_timing_report(self):
+        '''
+        {stage: {'calls', 'wall_time', 'bytes_read', 'bytes_written',
+                 'files_opened'}} if constructed with instrument=True.
+        nested stages (e.g. sections within write_metadata_draft) are
+        included in their parent's numbers.
+        '''
+        if self.instrumentation is None:
+            return None
+        return self.instrumentation.report()
+
+    @classmethod
+    def session_args(cls, **kwargs):
+        '''
+        constructor arguments with defaults filled in
+        (a deep copy, so later changes by the caller do not alter the record)
+        '''
+        bound = inspect.signature(cls.__init__).bind(None, **kwargs)
+        bound.apply_defaults()
+        args = dict(bound.arguments)
+        args.pop('self')
+        args.update(args.pop('kwargs', {}))
+        return {k: (v if isinstance(v, HeaderStore) else copy.deepcopy(v))
+                for k, v in args.items()}
+
+    # --- computed on first use
+
+    @property
+    def probes_used(self):
+        if self._probes_used is None:
+            with self._stage('load probes'):
+                self._probes_used = self.load_probe_metadata(
+                    self._probes_used_arg, self.probes_yml_dir)
+        return self._probes_used
+
+    @property
+    def epoch_label_tuples(self):
+        if self._epoch_label_tuples is None:
+            with self._stage('detect tasks'):
+                self._detect_tasks()
+        return self._epoch_label_tuples
+
+    @property
+    def detected_tasks(self):
+        if self._detected_tasks is None:
+            with self._stage('detect tasks'):
+                self._detect_tasks()
+        return self._detected_tasks
+
+    @property
+    def header_file(self):
+        if self._header_file is None:
+            with self._stage('find header'):
+                self._header_file = self._get_header_file(reconfig=self.reconfig)
+        return self._header_file
+
+    @property
+    def rec_header_digests(self):
+        '''
+        {rec file (or .rec_header.xml copy): header digest};
+        empty if the header is read from a reconfig file
+        '''
+        self.header_file # (found along with the header)
+        return self._rec_header_digests or {}
+
+    @property
+    def header_outliers(self):
+        ''' rec files (or .rec_header.xml copies) with a non-majority header '''
+        self.header_file # (found along with the header)
+        return self._header_outliers or []
+
+    @property
+    def ntrode_table(self):
+        if self._ntrode_table is None:
+            with self._stage('ntrodes config'):
+                self._get_ntrodes_config()
+        return self._ntrode_table
+
+    @property
+    def electrode_groups(self):
+        if self._electrode_groups is None:
+            with self._stage('ntrodes config'):
+                self._get_ntrodes_config()
+        return self._electrode_groups
+
+    @property
+    def probe_assignment_report(self):
+        if self._probe_assignment_report is None:
+            with self._stage('ntrodes config'):
+                self._get_ntrodes_config()
+        return self._probe_assignment_report
+
     def load_probe_metadata(self, probes_used, probes_yml_dir):
         probes = []
         for prb in probes_used:
-            # read in from probe metadata file
+            # read in from probe metadata file (or the probe registry)
             probe_yml_path = os.path.join(probes_yml_dir, prb['device_type'] + '.yml')
-            probe_yml = read_yml(probe_yml_path)
-            ch_cnts = [len(shank['electrodes']) for shank in probe_yml['shanks']]
-            prb['ch_per_probe'] = sum(ch_cnts)
-            if len(set(ch_cnts)) != 1:
-                raise RuntimeError('cannot parse probe with different sized shanks')
-            prb['ch_per_shank'] = ch_cnts[0]
-            prb['num_shanks'] = probe_yml['num_shanks']
-            prb['description'] = probe_yml['probe_description']
-            prb['units'] = probe_yml['units']
-            probes.append(prb)
+            # a new dict: the caller's probes_used may be shared between sessions
+            probes.append(dict(prb, **load_probe_summary(probe_yml_path)))
         
         # check probe with fewest # channels first
         probe_size = [(probe['ch_per_probe'], i) for i, probe in enumerate(probes)]
@@ -116,6 +304,11 @@ class NWBMetadataHelper():
         self.filename_format = filename_format
         self.filename_format_keys = format_keys
         self.filename_format_string = format_string
+        self.filename_parser = parse.compile(format_string)
+        self._dir_index = {key: dict(val, components={})
+                           for key, val in self._dir_index.items()}
+        self._epoch_label_tuples = None # tasks are detected again on demand
+        self._detected_tasks = None
 
     def get_filename(self, epoch, label, extension):
         if extension[0] == '.':
@@ -132,7 +325,15 @@ class NWBMetadataHelper():
         return filename
 
     def _get_header_file(self, reconfig=None):
-        ''' reconfig: path to reconfig file '''
+        '''
+        reconfig: path to reconfig file
+
+        returns either an XML file (reconfig or .rec_header.xml)
+        or a .rec file, whose header is then parsed in memory.
+        either way, the headers of all epochs are compared, and the first
+        file with the majority header is used (see header_outliers;
+        .rec files whose header cannot be read are outliers too).
+        '''
         if (reconfig is not None) and Path(reconfig).is_file():
             # use provided reconfig file
             return reconfig
@@ -140,29 +341,179 @@ class NWBMetadataHelper():
             # read from rec_header.xml files
             # (these files are generated during rec_to_nwb preprocessing)
             header_files = self.find_files_with_extension('.rec_header.xml')
-            if len(header_files) == 0:
-                # extract rec headers into a temporary directory
-                self.extract_rec_headers()
-                header_files = self.find_files_with_extension('.rec_header.xml',
-                                                              path=self.copy_path)
-            # just use the first header?
-            return header_files[0]
-
-    def extract_rec_headers(self):
-        ''' creates .rec_header.xml (trodesconfig) files '''
+            if len(header_files) > 0:
+                self._rec_header_digests = {
+                    os.path.abspath(f): self._header_file_digest(f)
+                    for f in header_files}
+                return self._majority_header(header_files, '.rec_header.xml')
+            # read the headers from the .rec files (or the header store)
+            rec_files = self.find_files_with_extension('.rec')
+            if len(rec_files) == 0:
+                raise FileNotFoundError('no .rec files in {}'.format(self.rec_path))
+            if self.copy_header:
+                # deduplicated copies, registered in the header store
+                summary = self.extract_rec_headers(max_workers=self.max_workers)
+            else:
+                summary = self._read_rec_headers(rec_files, max_workers=self.max_workers)
+            self._rec_header_digests = {os.path.abspath(res['rec_file']): res['digest']
+                                        for res in summary if res['status'] == 'ok'}
+            unreadable = [res for res in summary if res['status'] != 'ok']
+            if len(unreadable) == len(summary):
+                raise ValueError('no readable .rec header in {}: {}'.format(
+                    self.rec_path, unreadable[0]['error']))
+            if len(unreadable) > 0:
+                # e.g. an aborted (or still recording) epoch
+                warnings.warn('{} of {} .rec files have no readable header: {}'.format(
+                    len(unreadable), len(rec_files),
+                    ', '.join(['{} ({})'.format(os.path.basename(res['rec_file']),
+                                                res['error']) for res in unreadable])))
+            header_file = self._majority_header(rec_files, '.rec')
+            self._header_outliers = sorted(
+                self._header_outliers
+                + [os.path.abspath(res['rec_file']) for res in unreadable])
+            return header_file
+
+    @staticmethod
+    def _header_file_digest(header_file):
+        with open_source(header_file) as fh:
+            header_bytes = fh.read()
+        record_read(len(header_bytes))
+        return header_digest(header_bytes)
+
+    def _majority_header(self, files, kind):
+        ''' first of files with the majority digest; warns about the others '''
+        majority_digest, outliers = HeaderStore.group_by_digest(
+            self._rec_header_digests)
+        self._header_outliers = outliers
+        if len(outliers) > 0:
+            warnings.warn('{} of {} {} files have a different header '
+                          'config than the rest: {}'.format(
+                            len(outliers), len(files), kind,
+                            ', '.join([os.path.basename(f) for f in outliers])))
+        # first file with the majority config
+        for header_file in files:
+            if self._rec_header_digests.get(os.path.abspath(header_file)) == majority_digest:
+                return header_file
+
+    def extract_rec_headers(self, max_workers=1, use_processes=False,
+                            talkative=True):
+        '''
+        copies the rec headers (trodesconfig), once per distinct header,
+        as <digest>.xml into the header store's directory (copy_path if
+        the store is in memory), and registers them in the header store;
+        rec files already in the store (and unchanged) are not read again.
+
+        max_workers: number of concurrent extractions (1 runs serially).
+            extraction is dominated by waiting on (network) storage,
+            so a thread pool is the default; set use_processes=True
+            to use a process pool instead.
+        returns a list of per-file summaries (in rec file order):
+            {'rec_file', 'header_file', 'digest', 'status', 'error', 'elapsed'}
+        '''
+        with self._stage('extract rec headers'):
+            summary = self._extract_rec_headers(max_workers, use_processes, talkative)
+        if self.catalog is not None:
+            with self._stage('record in catalog'), Catalog(self.catalog) as catalog:
+                catalog.record_files(self, header_digests={
+                    res['rec_file']: res['digest'] for res in summary})
+        return summary
+
+    def _extract_rec_headers(self, max_workers, use_processes, talkative):
         rec_files_list = self.find_files_with_extension('.rec')
-        print('extracting {} rec header files into {}...'.format(
-            len(rec_files_list), self.copy_path))
-        for rec_file in rec_files_list:
-            copy_rec_header(rec_file, copy_dir=self.copy_path)
-        print('done.')
+        copy_dir = self.header_store.store_dir or self.copy_path
+        print('extracting {} rec headers into {}...'.format(
+            len(rec_files_list), copy_dir))
+
+        def report(result, index, summary):
+            self._report_extraction(result, index, summary, talkative)
+
+        summary = self._read_rec_headers(rec_files_list, copy_dir=copy_dir,
+                                         max_workers=max_workers,
+                                         use_processes=use_processes, report=report)
+        num_failed = sum([1 for res in summary if res['status'] != 'ok'])
+        num_headers = len(set([res['digest'] for res in summary if res['status'] == 'ok']))
+        if num_failed > 0:
+            print('done ({} distinct header(s)), with {} error(s).'.format(
+                num_headers, num_failed))
+        else:
+            print('done ({} distinct header(s)).'.format(num_headers))
+        return summary
+
+    def _read_rec_headers(self, rec_files, copy_dir=None, max_workers=1,
+                          use_processes=False, report=None):
+        '''
+        read the headers of rec_files (concurrently, see extract_rec_headers)
+        into the header store, catching errors per file; with copy_dir, each
+        distinct header is also written there as <digest>.xml.
+        rec files already in the store (and unchanged, with their copy on
+        disk) are not read again.
+        report: called with (result, index, summary) as each file is read
+        returns a list of per-file summaries (in rec_files order)
+        '''
+        summary = [None] * len(rec_files)
+        to_extract = []
+        for i, rec_file in enumerate(rec_files):
+            digest = self.header_store.lookup(rec_file)
+            header_file = None
+            if (digest is not None) and (copy_dir is not None):
+                header_file = os.path.join(copy_dir, digest + '.xml')
+                if not os.path.isfile(header_file):
+                    digest = None
+            if digest is not None:
+                summary[i] = {'rec_file': str(rec_file), 'header_file': header_file,
+                              'digest': digest, 'status': 'ok', 'error': None,
+                              'elapsed': 0.0}
+            else:
+                to_extract.append(i)
+        report = report or (lambda result, index, summary: None)
+        if max_workers == 1:
+            for i in to_extract:
+                summary[i] = self._register_header(
+                    _extract_one_header(rec_files[i], copy_dir))
+                report(summary[i], i, summary)
+        else:
+            pool_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+
+            def submit(pool, *args):
+                if use_processes:
+                    return pool.submit(_extract_one_header, *args)
+                # threads run in a copy of this context, so their I/O
+                # is counted in the current stage (see instrument.py)
+                return pool.submit(contextvars.copy_context().run,
+                                   _extract_one_header, *args)
+
+            with pool_class(max_workers=max_workers) as pool:
+                futures = {submit(pool, rec_files[i], copy_dir): i
+                           for i in to_extract}
+                for future in as_completed(futures):
+                    i = futures[future]
+                    summary[i] = self._register_header(future.result())
+                    report(summary[i], i, summary)
+        self.header_store.save()
+        return summary
+
+    def _register_header(self, result):
+        ''' add an extracted header to the header store; returns the summary entry '''
+        entry, header_bytes = result.pop('entry'), result.pop('header_bytes')
+        if result['status'] == 'ok':
+            self.header_store.add_entry(*entry, header_bytes)
+        return result
+
+    @staticmethod
+    def _report_extraction(result, index, summary, talkative):
+        if result['status'] != 'ok':
+            print(' * ERROR: {}: {}'.format(result['rec_file'], result['error']))
+        elif talkative:
+            num_done = sum([1 for res in summary if res is not None])
+            print(' [{}/{}] {} ({:.2f} s)'.format(num_done, len(summary),
+                os.path.basename(result['rec_file']), result['elapsed']))
 
     def _detect_tasks(self):
         # get a dict with list values
         parsed = self.scan_file_components(unique=False)
 
         # get a sorted list of (epoch, label_task, label_num) tuples
-        self.epoch_label_tuples = sorted(list(set(
+        self._epoch_label_tuples = sorted(list(set(
             [(epoch, *self._parse_label(label))
                 for epoch, label
                 in zip(parsed['epoch'], parsed['label'])]
@@ -171,11 +522,11 @@ class NWBMetadataHelper():
         # self.detected_tasks = list(set([t[1] for t in self.epoch_label_tuples]))
         # conserve epoch order
         detected_tasks = []
-        for t in self.epoch_label_tuples:
+        for t in self._epoch_label_tuples:
             if t[1] in detected_tasks:
                 continue
             detected_tasks.append(t[1])
-        self.detected_tasks = detected_tasks
+        self._detected_tasks = detected_tasks
 
     def set_basic_info(self, experimenter_name=None,
                              experiment_description=None,
@@ -202,17 +553,67 @@ class NWBMetadataHelper():
         self.basic_info = basic_info
 
     def get_config_from_header(self, reconfig=None):
-        xml_data = read_xml(self.header_file)
-        return xml_data['Configuration']
-
-    def write_metadata_draft(self, out_path='yaml/'):
-        ''' write section by section, to insert comments '''
+        '''
+        parsed once per header file; reused until the file changes
+        (cache key includes mtime) or invalidate_config_cache() is called.
+        the returned dict is shared, so treat it as read-only.
+        '''
+        header_file = str(self.header_file)
+        cache_key = (header_file, source_stat(header_file)[1])
+        if cache_key not in self._config_cache:
+            if strip_compression(header_file).endswith('.rec'):
+                # parsed once per distinct config in the header store
+                digest = self.header_store.add(header_file)
+                self._config_cache[cache_key] = self.header_store.get_config(digest)
+            else:
+                xml_data = read_xml(header_file)
+                self._config_cache[cache_key] = xml_data['Configuration']
+        return self._config_cache[cache_key]
+
+    def get_header_sections(self, streaming=True):
+        '''
+        compact records of the header sections we use
+        (ntrodes and DIO channels; see utils.stream_header_sections).
+        streaming=False derives the same records from the full-tree parse.
+        cached like get_config_from_header.
+        '''
+        header_file = str(self.header_file)
+        cache_key = (header_file, source_stat(header_file)[1], 'sections')
+        if cache_key not in self._config_cache:
+            if not streaming:
+                sections = self.sections_from_config(self.get_config_from_header())
+            elif strip_compression(header_file).endswith('.rec'):
+                digest = self.header_store.add(header_file)
+                sections = self.header_store.get_sections(digest)
+            else:
+                sections = stream_header_sections(header_file)
+            self._config_cache[cache_key] = sections
+        return self._config_cache[cache_key]
+
+    def invalidate_config_cache(self):
+        self._config_cache = {}
+
+    def write_metadata_draft(self, out_path='yaml/', record_inputs=True, inputs=None):
+        '''
+        render section by section (to insert comments) into one buffer,
+        then write the file once, atomically.
+        record_inputs: also write <session_id>_metadata_draft.inputs.json
+            (see inputs.py), so unchanged sessions can be skipped later.
+        inputs: the inputs to record, if already collected before this call
+            (see inputs.collect_inputs; e.g. by an incremental check)
+        '''
+        if record_inputs and (inputs is None):
+            # before the build: a file that changes meanwhile
+            # leaves a record that no longer matches (so is redrafted)
+            with self._stage('record inputs'):
+                inputs = collect_inputs(self.rec_path, self.init_args)
         
         os.makedirs(out_path, exist_ok=True)
         
         # write (or overwrite) to this file
         out_filename = self.session_id + '_metadata_draft.yml'
         out_file = os.path.join(out_path, out_filename)
+        buf = io.StringIO()
 
         # header
         meta_header = [
@@ -223,44 +624,55 @@ class NWBMetadataHelper():
             'and replace with appropriate values.'
             ''
             ]
-        self._write_comments(out_file, meta_header, reset=True)
+        self._write_comments(buf, meta_header)
 
         # basic info section
-        self._write_comments(out_file, ['', '', '=== basic information ==='])
-        # self._write_comments(out_file, ['', 'double check!'])
-        self._write_comments(out_file, [''])
-        append_yml(out_file, self.basic_info)
+        self._write_comments(buf, ['', '', '=== basic information ==='])
+        # self._write_comments(buf, ['', 'double check!'])
+        self._write_comments(buf, [''])
+        dump_yml(buf, self.basic_info)
 
         # then collect other fields
-        self._write_comments(out_file, ['', '', '=== environment ==='])
-        self._write_wrapper(out_file, self.get_data_acq_device)
-        self._write_wrapper(out_file, self.get_device)
-        self._write_wrapper(out_file, self.get_default_header_file_path)
-        self._write_wrapper(out_file, self.get_units)
-        self._write_wrapper(out_file, self.get_conversion)
-
-        self._write_comments(out_file, ['', '', '=== behavior / video ==='])
-        self._write_wrapper(out_file, self.get_cameras)
-        self._write_wrapper(out_file, self.get_tasks)
-        self._write_wrapper(out_file, self.get_behavioral_events)
-        self._write_wrapper(out_file, self.get_associated_files)
-        self._write_wrapper(out_file, self.get_associated_video_files)
-
-        self._write_comments(out_file, ['', '', '=== electrodes ==='])
-        self._write_wrapper(out_file, self.get_electrode_groups)
-        self._write_wrapper(out_file, self.get_ntrode_electrode_groups_channel_map)
+        self._write_comments(buf, ['', '', '=== environment ==='])
+        self._write_wrapper(buf, self.get_data_acq_device)
+        self._write_wrapper(buf, self.get_device)
+        self._write_wrapper(buf, self.get_default_header_file_path)
+        self._write_wrapper(buf, self.get_units)
+        self._write_wrapper(buf, self.get_conversion)
+
+        self._write_comments(buf, ['', '', '=== behavior / video ==='])
+        self._write_wrapper(buf, self.get_cameras)
+        self._write_wrapper(buf, self.get_tasks)
+        self._write_wrapper(buf, self.get_behavioral_events)
+        self._write_wrapper(buf, self.get_associated_files)
+        self._write_wrapper(buf, self.get_associated_video_files)
+
+        self._write_comments(buf, ['', '', '=== electrodes ==='])
+        self._write_wrapper(buf, self.get_electrode_groups)
+        self._write_wrapper(buf, self.get_ntrode_electrode_groups_channel_map)
 
         # last newline
-        self._write_comments(out_file, [''])
-
+        self._write_comments(buf, [''])
+
+        with self._stage('write draft'):
+            write_text_atomic(out_file, buf.getvalue())
+        if record_inputs:
+            with self._stage('record inputs'):
+                add_header_digests(inputs, self.rec_path, self.rec_header_digests)
+                write_inputs(inputs_path(out_path, self.session_id), inputs)
+        if self.catalog is not None:
+            with self._stage('record in catalog'), Catalog(self.catalog) as catalog:
+                catalog.record_session(self)
         print('Saved to file:')
         print(out_file)
+        return out_file
 
 
-    def _write_wrapper(self, out_file, func):
+    def _write_wrapper(self, fh, func):
         ''' getaround to write comments '''
         # prepare contents
-        metadata, comments = func()
+        with self._stage(func.__name__):
+            metadata, comments = func()
 
         # first write comments for the section
         spacing = [''] # some spacing between sections
@@ -268,27 +680,34 @@ class NWBMetadataHelper():
             comments = spacing + comments
         else:
             comments = spacing
-        self._write_comments(out_file, comments)
+        self._write_comments(fh, comments)
 
         # then append YAML-formatted metadata
-        append_yml(out_file, metadata)
+        with self._stage('yaml: ' + func.__name__):
+            dump_yml(fh, metadata)
 
     @staticmethod
     def _write_comments(file, comments, reset=False, marker='#'):
-        ''' file is a normal text file;
+        ''' file is a normal text file, or an open text stream;
         comments is just a list of strings
         '''
-        access_mode = 'a' # by default append
-        if reset:
-            access_mode = 'w'
-        with io.open(file, access_mode) as fh:
-            try:
-                for line in comments:
-                    if len(line.strip()) > 0 and line[0] != marker:
-                        line = '# ' + line
-                    fh.write(line + '\n')
-            except Exception as e: # catch *all* exceptions
-                print(e)
+        if hasattr(file, 'write'):
+            fh = file
+        else:
+            access_mode = 'a' # by default append
+            if reset:
+                access_mode = 'w'
+            fh = io.open(file, access_mode)
+        try:
+            for line in comments:
+                if len(line.strip()) > 0 and line[0] != marker:
+                    line = '# ' + line
+                fh.write(line + '\n')
+        except Exception as e: # catch *all* exceptions
+            print(e)
+        finally:
+            if fh is not file:
+                fh.close()
 
 
     def get_default_header_file_path(self):
@@ -323,11 +742,16 @@ class NWBMetadataHelper():
         ]
 
         raw_files = self.find_files_with_extension('.stateScriptLog')
+        epoch_times = self.get_epoch_times()
         meta_entry = []
         for file in raw_files:
             parsed = self.parse_filename(file)
             ext = parsed['extension']
             label = parsed['label']
+            if int(parsed['epoch']) in epoch_times:
+                comments.append('{}_{}: epoch {}, {}'.format(
+                    ext, label, int(parsed['epoch']),
+                    self._format_epoch_time(epoch_times[int(parsed['epoch'])])))
             out = {
                 'name': '{}_{}'.format(ext, label),
                 'description': '{} {}'.format(ext, self.unpack_label(label)),
@@ -393,12 +817,95 @@ class NWBMetadataHelper():
             meta_entry.append(out)
         return {entry_key: meta_entry}, comments
 
+    def get_rec_file_summaries(self):
+        '''
+        per .rec file: sample count and timestamp range from the file size
+        and the packet layout in its header (see utils.rec_data_summary).
+        returns a list of dicts, with 'path', 'epoch' and 'label' added.
+        '''
+        if self._rec_summaries is not None:
+            return self._rec_summaries
+        rec_files = self.find_files_with_extension('.rec')
+        parsed = self.parse_filenames(rec_files)
+        summaries = []
+        for path, epoch, label in zip(parsed['path'], parsed['epoch'], parsed['label']):
+            if not is_plain_file(path):
+                continue # compressed or archived: would need decompressing the data
+            try:
+                digest = self.header_store.add(str(path))
+                hardware = self.header_store.get_sections(digest)['hardware']
+                summary = rec_data_summary(str(path),
+                                           self.header_store.get_data_offset(str(path)),
+                                           hardware)
+            except Exception as e: # report, but don't fail the draft
+                warnings.warn('cannot read data range of {}: {}'.format(path, e))
+                continue
+            summary.update(path=str(path), epoch=int(epoch), label=label)
+            summaries.append(summary)
+        self._rec_summaries = summaries
+        return summaries
+
+    def validate_rec_files(self, num_checks=8, talkative=True):
+        '''
+        check every .rec file against the packet layout in its header
+        (see utils.validate_rec_data); nothing but a few packets is read.
+        num_checks: number of strided packets to sample (0: size check only)
+        returns a list of per-file results, with 'path' added
+        '''
+        results = []
+        for path in self.find_files_with_extension('.rec'):
+            if not is_plain_file(path):
+                # compressed or archived: would need decompressing the data
+                result = {'verdict': 'warn', 'num_samples': None, 'trailing_bytes': None,
+                          'messages': ['compressed or archived; data not checked']}
+            else:
+                try:
+                    digest = self.header_store.add(str(path))
+                    hardware = self.header_store.get_sections(digest)['hardware']
+                    result = validate_rec_data(str(path),
+                                               self.header_store.get_data_offset(str(path)),
+                                               hardware, num_checks=num_checks)
+                except Exception as e: # e.g. no header end found
+                    result = {'verdict': 'fail', 'messages': [repr(e)],
+                              'num_samples': None, 'trailing_bytes': None}
+            result['path'] = str(path)
+            results.append(result)
+            if talkative:
+                print('{}: {}'.format(os.path.basename(path), result['verdict']))
+                for message in result['messages']:
+                    print('  - {}'.format(message))
+        return results
+
+    def get_epoch_times(self):
+        ''' {epoch: (start_time, end_time, duration)} in seconds '''
+        epoch_times = {}
+        for summary in self.get_rec_file_summaries():
+            if summary['start_time'] is None:
+                continue
+            epoch = summary['epoch']
+            start, end = summary['start_time'], summary['end_time']
+            if epoch in epoch_times: # several files in one epoch
+                start = min(start, epoch_times[epoch][0])
+                end = max(end, epoch_times[epoch][1])
+            epoch_times[epoch] = (start, end, end - start)
+        return epoch_times
+
+    @staticmethod
+    def _format_epoch_time(epoch_time):
+        return '{:.3f} - {:.3f} s ({:.3f} s)'.format(*epoch_time)
+
     def get_tasks(self):
         entry_key = 'tasks'
         comments = [
             '' # extra spacing
         ]
 
+        epoch_times = self.get_epoch_times()
+        if len(epoch_times) > 0:
+            comments += ['epoch times from .rec files: start - end (duration)']
+            comments += ['  epoch {}: {}'.format(epoch, self._format_epoch_time(t))
+                         for epoch, t in sorted(epoch_times.items())]
+
         # placeholder for now
         meta_entry = []
         for i, task in enumerate(self.detected_tasks):
@@ -445,9 +952,17 @@ class NWBMetadataHelper():
             '' # extra spacing
         ]
 
-        xml_data = self.get_config_from_header()
+        header_sections = self.get_header_sections()
+        dio_stats = self.get_dio_stats()
+        findings = cross_check_dio(self.dio_id, dio_stats,
+                                   header_pins=header_dio_pins(header_sections['dio_channels']))
+        if len(findings) > 0:
+            comments += ['check DIO pins (from stateScriptLog and header):']
+            comments += ['  {}{}: {}'.format(kind, pin, message)
+                         for kind, pin, message in findings]
+
         meta_entry = []
-        index_offset = self.dio_id['index_offset'] # 0- or 1-based
+        index_offset = self.dio_id.get('index_offset', 0) # 0- or 1-based
         for key in self.dio_id:
             if not isinstance(self.dio_id[key], dict):
                 continue
@@ -457,68 +972,52 @@ class NWBMetadataHelper():
                     'name': v
                 }
                 meta_entry.append(out)
+        if len(meta_entry) == 0:
+            # nothing named: list the pins that were actually used
+            for key in ['Din', 'Dout']:
+                for pin in sorted(dio_stats[key]):
+                    out = {
+                        'description': '{}{}'.format(key, pin),
+                        'name': self.placeholder_text
+                    }
+                    meta_entry.append(out)
         return {entry_key: meta_entry}, comments
 
+    def get_dio_stats(self):
+        '''
+        DIO pins that changed state in this session's stateScriptLogs,
+        with counts and first/last times (see statescript.scan_dio_changes)
+        '''
+        if self._dio_stats is None:
+            log_files = self.find_files_with_extension('.stateScriptLog')
+            self._dio_stats = scan_dio_changes([str(f) for f in log_files])
+        return self._dio_stats
+
     def _get_ntrodes_config(self):
-        xml_data = self.get_config_from_header()
-        ntrodes_config = self.extract_ntrodes_info(xml_data)
-        
+        header_sections = self.get_header_sections()
+        ntrode_table = NTrodeTable.from_records(header_sections['ntrodes'])
+        for i in range(len(ntrode_table)):
+            if not ntrode_table.complete[i]:
+                print(' * WARNING: incomplete ntrode id {}'.format(
+                    ntrode_table.ntrode_id[i]))
+
         # assign shanks to electrode groups
-        electrode_groups = []
-        group_id = 0
-        shank_id = 0
-        ch_cnt = 0
-        probe_cnt = 0
-        last_probe = None
-        for ntrode in ntrodes_config:
-            try:
-                num_channels = sum([1 for k in ntrode['map']])
-            except KeyError:
-                continue
-            found_probe = False
-
-            for probe in self.probes_used:
-                if num_channels <= probe['ch_per_shank']:
-                    current_probe = probe['device_type']
-                    new_probe_type = (last_probe != current_probe)
-                    exceeds_probe_size = (shank_id >= probe['num_shanks'])
-                    if (new_probe_type or exceeds_probe_size):
-                        # assign to a new electrode group
-                        if last_probe is not None:
-                            group_id += 1
-                            probe_cnt += 1
-                        if new_probe_type:
-                            probe_cnt = 0
-                        ch_cnt = 0
-                        shank_id = 0
-                        group = {'id': group_id,
-                                 'device_type': current_probe,
-                                 'probe_cnt': probe_cnt}
-                        for k in probe:
-                            group[k] = probe[k]
-                        electrode_groups.append(group)
-                    ch_id_base = ch_cnt
-                    ch_cnt += num_channels
-                    shank_id += 1
-                    ntrode['electrode_group'] = group_id
-                    found_probe = True
-                    last_probe = current_probe
-                    break
-            if not found_probe:
-                raise RuntimeError('unknown shank type')
-            self._remap_channels(ntrode, base=ch_id_base)
-            
+        assignment = ProbeAssigner(self.probes_used).assign(ntrode_table)
+        for entry in assignment['report']:
             # display warning
-            if num_channels < probe['ch_per_shank']:
-                warnings.warn('incomplete ntrode {}'.format(ntrode['ntrode_id']))
-                
-        self.ntrodes_config = ntrodes_config
-        self.electrode_groups = electrode_groups
-        
-    def _remap_channels(self, ntrode, base=0):
-        for k in ntrode['map']:
-            # ignore existing channel number?
-            ntrode['map'][k] = base + int(k)
+            if entry['incomplete_shank']:
+                warnings.warn('incomplete ntrode {}'.format(entry['ntrode_id']))
+
+        ntrode_table.assign_groups(assignment['group_ids'])
+        ntrode_table.remap_channels(assignment['ch_id_bases'])
+        self._ntrode_table = ntrode_table
+        self._electrode_groups = assignment['electrode_groups']
+        self._probe_assignment_report = assignment['report']
+
+    @property
+    def ntrodes_config(self):
+        ''' per-ntrode dicts, as written to the YAML (built on demand) '''
+        return self.ntrode_table.to_dicts()
 
     def get_electrode_groups(self):
         entry_key = 'electrode groups'
@@ -526,18 +1025,19 @@ class NWBMetadataHelper():
 
         meta_entry = []
         for group in self.electrode_groups:
-            # description = group.get('description', self.placeholder_text)
-            description = '{} {}'.format(group['name'], group['probe_cnt'])
+            probe = group['probe'] # shared probe descriptor
+            # description = probe.get('description', self.placeholder_text)
+            description = '{} {}'.format(probe['name'], group['probe_cnt'])
             out = {
                 'id': group['id'],
-                'location': group['location'],
+                'location': probe['location'],
                 'device_type': group['device_type'],
                 'description': description,
-                'targeted_location': group['location'],
-                'targeted_x': group.get('targeted_x', 0.0),
-                'targeted_y': group.get('targeted_y', 0.0),
-                'targeted_z': group.get('targeted_z', 0.0),
-                'units': group['units']
+                'targeted_location': probe['location'],
+                'targeted_x': probe.get('targeted_x', 0.0),
+                'targeted_y': probe.get('targeted_y', 0.0),
+                'targeted_z': probe.get('targeted_z', 0.0),
+                'units': probe['units']
             }
             meta_entry.append(out)
         return {entry_key: meta_entry}, comments
@@ -574,45 +1074,140 @@ class NWBMetadataHelper():
             ntrodes_info.append(nt)
         return ntrodes_info
 
+    @staticmethod
+    def sections_from_config(config_all):
+        ''' full-tree fallback for utils.stream_header_sections '''
+        ntrodes = []
+        for nt in NWBMetadataHelper.extract_ntrodes_info(config_all):
+            hw_chans = list(nt['map'].values()) if 'map' in nt else None
+            ntrodes.append((nt['ntrode_id'], hw_chans))
+        dio_channels = []
+        hardware = {'sampling_rate': None, 'num_channels': 0,
+                    'sys_time_included': False, 'devices': []}
+        hardware_config = config_all.get('HardwareConfiguration', {})
+        read_hardware_attrs(hardware, hardware_config)
+        devices = hardware_config.get('Device', [])
+        if isinstance(devices, dict):
+            devices = [devices]
+        for device in devices:
+            if device.get('numBytes') is not None:
+                hardware['devices'].append((device.get('name'), int(device['numBytes'])))
+            channels = device.get('Channel', [])
+            if isinstance(channels, dict):
+                channels = [channels]
+            for channel in channels:
+                if channel.get('dataType') != 'digital':
+                    continue
+                dio_channels.append({
+                    'device': device.get('name'),
+                    'id': channel.get('id'),
+                    'input': channel.get('input') == '1',
+                    'start_byte': int(channel.get('startByte', 0)),
+                    'bit': int(channel.get('bit', 0))
+                    })
+        return {'ntrodes': ntrodes, 'dio_channels': dio_channels,
+                'hardware': hardware}
+
     def find_files_with_extension(self, extension, path=None, sort_list=True):
         '''
-        extension: a string like '.rec'
+        extension: a string like '.rec' (glob wildcards allowed, e.g. '.*h264')
         returns a list of POSIXPATH objects '''
-        path = path or self.rec_path
         if extension[0] != '.':
             extension = '.' + extension
-        files = []
-        for file_path in Path(path).glob('**/*' + extension):
-            files.append(file_path)
+        index = self._get_dir_index(path)
+        last_ext = '.' + extension.rsplit('.', 1)[-1]
+        if any(c in last_ext for c in '*?['):
+            candidates = index['all']
+        else:
+            candidates = index['by_extension'].get(last_ext, [])
+        pattern = '*' + extension
+        # (compressed .rec files count as .rec files)
+        files = [Path(f) for f in candidates
+                 if fnmatch.fnmatchcase(strip_compression(os.path.basename(f)), pattern)]
         if sort_list:
             return sorted(files)
         return files
 
+    def _get_dir_index(self, path=None):
+        '''
+        single-pass index of all files under path (default: rec_path),
+        grouped by (last) extension; built once and reused until refresh().
+        the members of .tar archives are listed as files under the archive
+        (e.g. <rec_path>/session.tar/<member>; see archive.py), and
+        compressed .rec files (.rec.gz, .rec.xz) are grouped with .rec.
+        paths are as found under path (relative if path is), while the
+        index itself is kept by absolute path.
+        '''
+        scan_path = str(path or self.rec_path)
+        path = os.path.abspath(scan_path)
+        if path not in self._dir_index:
+            all_files = []
+            for file_path in scan_directory(scan_path):
+                if is_archive(file_path):
+                    all_files.extend(expand_archive(file_path))
+                else:
+                    all_files.append(file_path)
+            by_extension = {}
+            for file_path in all_files:
+                ext = os.path.splitext(strip_compression(file_path))[1]
+                by_extension.setdefault(ext, []).append(file_path)
+            self._dir_index[path] = {'all': all_files,
+                                     'by_extension': by_extension,
+                                     'components': {}}
+        return self._dir_index[path]
+
+    def list_files(self, path=None):
+        ''' all files under path (default: rec_path), archive members included '''
+        return list(self._get_dir_index(path)['all'])
+
+    def refresh(self, path=None):
+        ''' drop the cached directory index (for one path, or all) '''
+        if path is None:
+            self._dir_index = {}
+        else:
+            self._dir_index.pop(os.path.abspath(path), None)
+
+    @property
+    def task_code(self):
+        return self._task_code
+
+    @task_code.setter
+    def task_code(self, task_code):
+        self._task_code = task_code
+        self._parsed_labels = {} # memo for _parse_label
+        self._epoch_label_tuples = None # tasks are detected again on demand
+        self._detected_tasks = None
+
     def unpack_label(self, label, separator=' '):
-        for k in self.task_code:
-            if k in label:
-                return label.replace(k, self.task_code[k] + separator)
+        k, _ = self._parse_label(label)
+        if k in self.task_code:
+            return label.replace(k, self.task_code[k] + separator)
         # if not found
         return label
 
     def _parse_label(self, label):
         ''' parse label 'r1' into a task code 'r' and a number '1' '''
-        for k in self.task_code:
-            if k in label:
-                return k, label.replace(k, '')
-        # if not found
-        return label, ''
+        if label not in self._parsed_labels:
+            parsed = (label, '') # if not found
+            for k in self.task_code:
+                if k in label:
+                    parsed = (k, label.replace(k, ''))
+                    break
+            self._parsed_labels[label] = parsed
+        return self._parsed_labels[label]
 
     def scan_file_components(self, unique=True):
-        parsed_list = []
-        for file_path in Path(self.rec_path).glob(
-                    '**/{}_{}_*.*'.format(self.date, self.animal_nickname)
-                    ):
-            parsed = self.parse_filename(file_path)
-            parsed_list.append(parsed)
+        index = self._get_dir_index()
+        pattern = '{}_{}_*.*'.format(self.date, self.animal_nickname)
+        cache_key = (pattern, self.filename_format_string)
+        if cache_key not in index['components']:
+            index['components'][cache_key] = self.parse_filenames(
+                [file_path for file_path in index['all']
+                 if fnmatch.fnmatchcase(os.path.basename(file_path), pattern)])
+        parsed_columns = index['components'][cache_key]
         out = {}
         for k in self.filename_format_keys:
-            v = [p[k] for p in parsed_list]
+            v = list(parsed_columns[k])
             if unique:
                 v = list(set(v))
             out[k] = v
@@ -627,12 +1222,31 @@ class NWBMetadataHelper():
 
     def parse_filename(self, file_path):
         basename = os.path.basename(file_path) # FILENAME.ext
-        parsed_list = parse.parse(self.filename_format_string, basename)
+        parsed_list = self.filename_parser.parse(basename).fixed
         parsed = {}
         for k, v in zip(self.filename_format_keys, parsed_list):
             parsed[k] = v
         return parsed
 
+    def parse_filenames(self, file_paths):
+        '''
+        bulk version of parse_filename, with columnar output:
+        a dict of lists, one per filename format key, plus 'path'.
+        files not matching the filename format are skipped.
+        '''
+        keys = self.filename_format_keys
+        columns = {k: [] for k in keys}
+        columns['path'] = []
+        parser = self.filename_parser
+        for file_path in file_paths:
+            result = parser.parse(os.path.basename(file_path))
+            if result is None:
+                continue
+            for k, v in zip(keys, result.fixed):
+                columns[k].append(v)
+            columns['path'].append(file_path)
+        return columns
+
     @staticmethod
     def detect_filename_format(format_input):
         format_keys = re.findall(r"\{(\w+)\}", format_input)
@@ -0,0 +1,199 @@
+# ntrodes.py
+# compact, array-backed ntrode / channel-map table
+
+from array import array
+
+
+UNASSIGNED = -1 # electrode group not assigned yet
+
+
+class NTrodeTable():
+    '''
+    all ntrodes of a header in a few contiguous integer arrays
+    (instead of one dict with a dict-valued 'map' per ntrode):
+    - ntrode_id[i], electrode_group[i], complete[i] (0: incomplete ntrode)
+    - channels of ntrode i are offsets[i]:offsets[i + 1] in
+      hw_chan (from the header) and channel_map (the remapped channel ids)
+    converted to the YAML structure only by to_dicts().
+    '''
+
+    def __init__(self, ntrode_ids, complete, offsets, hw_chan):
+        self.ntrode_id = array('i', ntrode_ids)
+        self.complete = array('b', complete)
+        self.offsets = array('i', offsets)
+        self.hw_chan = array('i', hw_chan)
+        # initially, channel i of an ntrode maps to its hwChan
+        self.channel_map = array('i', hw_chan)
+        self.electrode_group = array('i', [UNASSIGNED]) * len(self.ntrode_id)
+
+    @classmethod
+    def from_records(cls, ntrode_records):
+        ''' from (ntrode_id, hwChan list or None) records (utils.stream_header_sections) '''
+        ntrode_ids = []
+        complete = []
+        offsets = [0]
+        hw_chan = []
+        for ntrode_id, hw_chans in ntrode_records:
+            ntrode_ids.append(ntrode_id)
+            complete.append(hw_chans is not None)
+            if hw_chans is not None:
+                hw_chan.extend(hw_chans)
+            offsets.append(len(hw_chan))
+        return cls(ntrode_ids, complete, offsets, hw_chan)
+
+    def __len__(self):
+        return len(self.ntrode_id)
+
+    def num_channels(self):
+        ''' channels per ntrode (array) '''
+        offsets = self.offsets
+        return array('i', [offsets[i + 1] - offsets[i] for i in range(len(self))])
+
+    def remap_channels(self, bases):
+        '''
+        channel k of ntrode i becomes bases[i] + k (ignores hwChan);
+        ntrodes with a negative base keep their current map
+        '''
+        offsets = self.offsets
+        channel_map = self.channel_map
+        for i, base in enumerate(bases):
+            if base < 0:
+                continue
+            start, stop = offsets[i], offsets[i + 1]
+            channel_map[start:stop] = array('i', range(base, base + stop - start))
+
+    def assign_groups(self, group_ids):
+        ''' electrode group of every ntrode (UNASSIGNED for none) '''
+        self.electrode_group = array('i', group_ids)
+
+    def to_dicts(self, unknown='Unknown'):
+        ''' the YAML structure ('ntrode electrode group channel map' entries) '''
+        ntrodes_info = []
+        offsets = self.offsets
+        channel_map = self.channel_map
+        for i in range(len(self)):
+            group = self.electrode_group[i]
+            nt = dict(ntrode_id=self.ntrode_id[i],
+                      electrode_group=(unknown if group == UNASSIGNED else group),
+                      bad_channels=[]
+                      )
+            if self.complete[i]:
+                start = offsets[i]
+                nt['map'] = {k: channel_map[start + k]
+                             for k in range(offsets[i + 1] - start)}
+            ntrodes_info.append(nt)
+        return ntrodes_info
+
+
+# --- probe / shank assignment
+
+class ProbeAssignmentError(RuntimeError):
+    ''' some ntrodes fit no probe; the message lists all of them '''
+    pass
+
+
+class ProbeAssigner():
+    '''
+    assigns ntrodes (shanks) to electrode groups, in header order:
+    each ntrode goes to the first probe (smallest first) whose shanks have
+    enough channels; a new electrode group starts when the probe type
+    changes or when the current probe has no shank left.
+
+    probes: probe descriptors (see NWBMetadataHelper.load_probe_metadata),
+        sorted by size; electrode groups refer to these, not copies.
+    '''
+
+    def __init__(self, probes):
+        self.probes = probes
+        max_channels = max([probe['ch_per_shank'] for probe in probes], default=0)
+        # channel count -> indices of the probes that fit, in order
+        self._candidates = [
+            [j for j, probe in enumerate(probes) if probe['ch_per_shank'] >= n]
+            for n in range(max_channels + 1)]
+
+    def candidates(self, num_channels):
+        ''' probes with at least num_channels channels per shank '''
+        if num_channels >= len(self._candidates):
+            return []
+        return [self.probes[j] for j in self._candidates[num_channels]]
+
+    def assign(self, ntrode_table):
+        '''
+        returns a dict with
+        - 'group_ids', 'ch_id_bases': arrays, one entry per ntrode
+          (see NTrodeTable.assign_groups / remap_channels)
+        - 'electrode_groups': list of {'id', 'device_type', 'probe_cnt', 'probe'}
+        - 'report': one {'ntrode_id', 'num_channels', 'group', 'shank',
+          'incomplete_shank', 'reason'} per ntrode
+        raises ProbeAssignmentError (listing every failed ntrode) if an
+        ntrode fits no probe.
+        '''
+        num_ntrodes = len(ntrode_table)
+        group_ids = array('i', [UNASSIGNED]) * num_ntrodes
+        ch_id_bases = array('i', [-1]) * num_ntrodes
+        electrode_groups = []
+        report = []
+        failed = []
+
+        group_id = 0
+        shank_id = 0
+        ch_cnt = 0
+        probe_cnt = 0
+        last_probe = None
+        for i, num_channels in enumerate(ntrode_table.num_channels()):
+            entry = {'ntrode_id': ntrode_table.ntrode_id[i],
+                     'num_channels': num_channels,
+                     'group': None, 'shank': None, 'incomplete_shank': False,
+                     'reason': None}
+            report.append(entry)
+            if not ntrode_table.complete[i]:
+                entry['reason'] = 'incomplete ntrode (no channel map); not assigned'
+                continue
+            candidates = self.candidates(num_channels)
+            if len(candidates) == 0:
+                entry['reason'] = 'no probe has {} or more channels per shank ({})'.format(
+                    num_channels, ', '.join(['{}: {}'.format(p['device_type'], p['ch_per_shank'])
+                                             for p in self.probes]) or 'no probes')
+                failed.append(entry)
+                continue
+
+            probe = candidates[0]
+            current_probe = probe['device_type']
+            new_probe_type = (last_probe != current_probe)
+            exceeds_probe_size = (shank_id >= probe['num_shanks'])
+            if (new_probe_type or exceeds_probe_size):
+                # assign to a new electrode group
+                if last_probe is not None:
+                    group_id += 1
+                    probe_cnt += 1
+                if new_probe_type:
+                    probe_cnt = 0
+                ch_cnt = 0
+                shank_id = 0
+                electrode_groups.append({'id': group_id,
+                                         'device_type': current_probe,
+                                         'probe_cnt': probe_cnt,
+                                         'probe': probe})
+                why = 'new probe type' if new_probe_type else 'previous probe is full'
+                reason = '{} channels fit {} ({} per shank); new group ({})'.format(
+                    num_channels, current_probe, probe['ch_per_shank'], why)
+            else:
+                reason = '{} channels fit {} ({} per shank); next shank of the group'.format(
+                    num_channels, current_probe, probe['ch_per_shank'])
+            incomplete_shank = (num_channels < probe['ch_per_shank'])
+            if incomplete_shank:
+                reason += '; incomplete shank'
+            group_ids[i] = group_id
+            ch_id_bases[i] = ch_cnt
+            entry.update(group=group_id, shank=shank_id,
+                         incomplete_shank=incomplete_shank, reason=reason)
+            ch_cnt += num_channels
+            shank_id += 1
+            last_probe = current_probe
+
+        if len(failed) > 0:
+            raise ProbeAssignmentError('unknown shank type for {} ntrode(s):\n{}'.format(
+                len(failed), '\n'.join(['  ntrode {}: {}'.format(e['ntrode_id'], e['reason'])
+                                        for e in failed])))
+        return {'group_ids': group_ids, 'ch_id_bases': ch_id_bases,
+                'electrode_groups': electrode_groups, 'report': report}
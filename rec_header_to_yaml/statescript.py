@@ -0,0 +1,113 @@
+# statescript.py
+# stream stateScriptLog files and collect the DIO pins that changed state
+
+import os
+import re
+
+from .instrument import record_read
+from .archive import open_source, is_plain_file
+
+
+DIO_PIN_PATTERN = re.compile(r'(Din|Dout)(\d+)$') # e.g. ECU_Din1, Controller_Dout12
+
+
+def iter_dio_states(log_path, encoding='ISO-8859-1'):
+    '''
+    yield (time, input_state, output_state) for every DIO state line
+    ('<time> <input bitmask> <output bitmask>') of a stateScriptLog;
+    comments and other event lines are skipped. reads line by line
+    (log_path may be an archive member; see archive.open_source).
+    '''
+    if is_plain_file(log_path):
+        record_read(os.path.getsize(log_path))
+        num_bytes = None
+    else:
+        num_bytes = 0 # (no size to go by: count the lines as they are read)
+    try:
+        with open_source(log_path) as fh:
+            for line in fh:
+                if num_bytes is not None:
+                    num_bytes += len(line)
+                line = line.decode(encoding, errors='replace')
+                if line.startswith('#'):
+                    continue
+                tokens = line.split()
+                if len(tokens) != 3:
+                    continue
+                try:
+                    yield int(tokens[0]), int(tokens[1]), int(tokens[2])
+                except ValueError:
+                    continue
+    finally:
+        if num_bytes is not None:
+            record_read(num_bytes)
+
+
+def _update_pin_stats(stats, changed, t):
+    pin = 1 # bit 0 is pin 1
+    while changed:
+        if changed & 1:
+            if pin in stats:
+                stats[pin]['count'] += 1
+                stats[pin]['last_time'] = t
+            else:
+                stats[pin] = {'count': 1, 'first_time': t, 'last_time': t}
+        changed >>= 1
+        pin += 1
+
+
+def scan_dio_changes(log_paths, stats=None):
+    '''
+    collect the DIO pins that changed state in one or more stateScriptLogs.
+    the first state line of each log is the baseline (not a change).
+    returns {'Din': {pin: {'count', 'first_time', 'last_time'}},
+             'Dout': {...}}, pins 1-based;
+    pass stats to accumulate into an earlier result.
+    '''
+    if isinstance(log_paths, (str, bytes)) or not hasattr(log_paths, '__iter__'):
+        log_paths = [log_paths]
+    if stats is None:
+        stats = {'Din': {}, 'Dout': {}}
+    for log_path in log_paths:
+        last_in = last_out = None
+        for t, state_in, state_out in iter_dio_states(log_path):
+            if last_in is not None:
+                _update_pin_stats(stats['Din'], state_in ^ last_in, t)
+                _update_pin_stats(stats['Dout'], state_out ^ last_out, t)
+            last_in, last_out = state_in, state_out
+    return stats
+
+
+def header_dio_pins(dio_channels):
+    ''' {'Din': set of pins, 'Dout': set of pins} from header DIO channel ids '''
+    pins = {'Din': set(), 'Dout': set()}
+    for channel in dio_channels:
+        match = DIO_PIN_PATTERN.search(channel['id'] or '')
+        if match is not None:
+            pins[match.group(1)].add(int(match.group(2)))
+    return pins
+
+
+def cross_check_dio(dio_id, dio_stats, header_pins=None):
+    '''
+    compare the named pins in dio_id against the pins that changed state
+    (dio_stats, from scan_dio_changes) and the header's DIO channels.
+    dio_id pin numbers are key + dio_id['index_offset'], as in the draft.
+    returns a list of (kind, pin, message) findings
+    '''
+    findings = []
+    index_offset = dio_id.get('index_offset', 0)
+    for kind in ['Din', 'Dout']:
+        named = {n + index_offset: name
+                 for n, name in (dio_id.get(kind) or {}).items()}
+        active = dio_stats.get(kind, {})
+        for pin in sorted(set(active) - set(named)):
+            findings.append((kind, pin, 'changed state {} times but has no name'.format(
+                active[pin]['count'])))
+        for pin in sorted(set(named) - set(active)):
+            findings.append((kind, pin, '{} never changed state'.format(named[pin])))
+        if header_pins is not None and len(header_pins[kind]) > 0:
+            for pin in sorted(set(named) - header_pins[kind]):
+                findings.append((kind, pin, '{} is not a DIO channel in the header'.format(
+                    named[pin])))
+    return findings
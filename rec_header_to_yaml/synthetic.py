@@ -0,0 +1,173 @@
+# synthetic.py
+# generate synthetic Trodes-style sessions (for benchmarks and examples)
+
+import os
+import io
+import struct
+
+from .utils import packet_layout
+
+
+DEFAULT_FILENAME_FORMAT = '{date}_{animal}_{epoch}_{label}.{extension}'
+
+
+def make_header(num_ntrodes=32, channels_per_ntrode=4, num_dio=12,
+                sampling_rate=30000):
+    ''' a Trodes-style <Configuration> header (bytes, ending in a newline) '''
+    num_channels = num_ntrodes * channels_per_ntrode
+    dio_bytes = max(1, (2 * num_dio + 7) // 8) # inputs and outputs
+    lines = [
+        '<?xml version="1.0"?>',
+        '<Configuration>',
+        ' <GlobalConfiguration filePrefix="" realtimeMode="0" '
+        'systemTimeAtCreation="0" timestampAtCreation="0"/>',
+        ' <HardwareConfiguration samplingRate="{}" numChannels="{}">'.format(
+            sampling_rate, num_channels),
+        '  <Device name="ECU" numBytes="{}" available="1" '
+        'packetOrderPreference="10">'.format(dio_bytes)]
+    for kind, is_input, first_bit in [('Din', 1, 0), ('Dout', 0, num_dio)]:
+        for pin in range(1, num_dio + 1):
+            bit = first_bit + pin - 1
+            lines.append('   <Channel id="ECU_{}{}" bit="{}" startByte="{}" '
+                         'dataType="digital" input="{}"/>'.format(
+                            kind, pin, bit % 8, bit // 8, is_input))
+    lines += ['  </Device>',
+              ' </HardwareConfiguration>',
+              ' <StreamDisplay columns="2" pages="1" backgroundColor="#808080"/>',
+              ' <SpikeConfiguration categories="">']
+    for n in range(num_ntrodes):
+        lines.append('  <SpikeNTrode id="{}" refNTrode="1" refChan="1" '
+                     'filterOn="1" lowFilter="600" highFilter="6000">'.format(n + 1))
+        for c in range(channels_per_ntrode):
+            lines.append('   <SpikeChannel hwChan="{}" thresh="60" maxDisp="400" '
+                         'triggerOn="1"/>'.format(n * channels_per_ntrode + c))
+        lines.append('  </SpikeNTrode>')
+    lines += [' </SpikeConfiguration>', '</Configuration>', '']
+    return '\n'.join(lines).encode()
+
+
+def _hardware_of(num_ntrodes, channels_per_ntrode, num_dio, sampling_rate):
+    dio_bytes = max(1, (2 * num_dio + 7) // 8)
+    return {'sampling_rate': float(sampling_rate),
+            'num_channels': num_ntrodes * channels_per_ntrode,
+            'sys_time_included': False,
+            'devices': [('ECU', dio_bytes)]}
+
+
+def write_rec_file(path, header, hardware, num_packets, first_timestamp=0,
+                   sparse=False, chunk_packets=4096):
+    '''
+    header followed by num_packets packets with consecutive timestamps.
+    sparse: only write the first and last packet and leave a hole in
+        between (fast, and takes no disk space; for size-only benchmarks)
+    '''
+    layout = packet_layout(hardware)
+    packet_size = layout['packet_size']
+    ts_byte = layout['timestamp_byte']
+    template = bytearray(packet_size)
+    template[0] = 0x55
+
+    def packets(start, count):
+        buf = template * count
+        for k in range(count):
+            struct.pack_into('<I', buf, k * packet_size + ts_byte,
+                             first_timestamp + start + k)
+        return buf
+
+    with io.open(path, 'wb') as fh:
+        fh.write(header)
+        if num_packets == 0:
+            return
+        if sparse:
+            fh.write(packets(0, 1))
+            fh.seek(len(header) + (num_packets - 1) * packet_size)
+            fh.write(packets(num_packets - 1, 1))
+            return
+        for start in range(0, num_packets, chunk_packets):
+            fh.write(packets(start, min(chunk_packets, num_packets - start)))
+
+
+def write_statescript_log(path, num_events=1000, dio_pins=(1, 2, 3), first_time=0):
+    ''' comments, then '<time> <inputs> <outputs>' DIO state lines '''
+    with io.open(path, 'w') as fh:
+        fh.write('# synthetic stateScriptLog\n')
+        fh.write('{} 0 0\n'.format(first_time))
+        for k in range(num_events):
+            pin = dio_pins[k % len(dio_pins)]
+            state = (1 << (pin - 1)) if (k % 2 == 0) else 0
+            fh.write('{} {} {}\n'.format(first_time + 100 * (k + 1), state, state))
+
+
+def write_probe_file(probes_yml_dir, device_type='tetrode_12.5', num_shanks=1,
+                     ch_per_shank=4, description='synthetic probe', units='um'):
+    ''' a probe definition in the format read by load_probe_metadata '''
+    os.makedirs(probes_yml_dir, exist_ok=True)
+    lines = ['probe_type: {}'.format(device_type),
+             'units: {}'.format(units),
+             'probe_description: {}'.format(description),
+             'num_shanks: {}'.format(num_shanks),
+             'shanks:']
+    for shank in range(num_shanks):
+        lines += ['  - shank_id: {}'.format(shank), '    electrodes:']
+        for e in range(ch_per_shank):
+            lines += ['      - id: {}'.format(shank * ch_per_shank + e),
+                      '        rel_x: 0', '        rel_y: {}'.format(20 * e),
+                      '        rel_z: 0']
+    path = os.path.join(probes_yml_dir, device_type + '.yml')
+    with io.open(path, 'w') as fh:
+        fh.write('\n'.join(lines) + '\n')
+    return path
+
+
+def make_session(data_path, animal_name='synth', date='20200101', num_epochs=4,
+                 num_ntrodes=32, channels_per_ntrode=4, num_dio=12,
+                 num_packets=30000, sampling_rate=30000, sparse=False,
+                 num_events=1000, num_video_chunks=1,
+                 filename_format=DEFAULT_FILENAME_FORMAT, task_codes=('s', 'r')):
+    '''
+    a <data_path>/<animal>/raw/<date>/ session: for each epoch a .rec file,
+    a .stateScriptLog and h264 stubs, named per filename_format,
+    alternating the task codes (s1, r1, s2, r2, ...).
+    returns the session directory.
+    '''
+    rec_path = os.path.join(data_path, animal_name, 'raw', date)
+    os.makedirs(rec_path, exist_ok=True)
+    header = make_header(num_ntrodes, channels_per_ntrode, num_dio, sampling_rate)
+    hardware = _hardware_of(num_ntrodes, channels_per_ntrode, num_dio, sampling_rate)
+    for i in range(num_epochs):
+        epoch = '{:02d}'.format(i + 1)
+        label = '{}{}'.format(task_codes[i % len(task_codes)], i // len(task_codes) + 1)
+
+        def filename(extension):
+            return os.path.join(rec_path, filename_format.format(
+                date=date, animal=animal_name, epoch=epoch, label=label,
+                extension=extension))
+
+        first_timestamp = i * (num_packets + sampling_rate) # gaps between epochs
+        write_rec_file(filename('rec'), header, hardware, num_packets,
+                       first_timestamp=first_timestamp, sparse=sparse)
+        write_statescript_log(filename('stateScriptLog'), num_events=num_events,
+                              first_time=first_timestamp // (sampling_rate // 1000))
+        for chunk in range(1, num_video_chunks + 1):
+            io.open(filename('{}.h264'.format(chunk)), 'wb').close()
+    return rec_path
+
+
+def make_cohort(data_path, num_animals=2, num_dates=2, first_date=20200101,
+                channels_per_ntrode=4, **session_kwargs):
+    '''
+    num_animals x num_dates sessions (see make_session) under data_path,
+    plus a matching probe file in <data_path>/probes/.
+    returns (sessions, probes_yml_dir) with sessions as in batch.discover_sessions
+    '''
+    probes_yml_dir = os.path.join(data_path, 'probes')
+    write_probe_file(probes_yml_dir, ch_per_shank=channels_per_ntrode)
+    sessions = []
+    for a in range(num_animals):
+        animal_name = 'synth{}'.format(a + 1)
+        for d in range(num_dates):
+            date = str(first_date + d)
+            make_session(data_path, animal_name=animal_name, date=date,
+                         channels_per_ntrode=channels_per_ntrode, **session_kwargs)
+            sessions.append({'animal_name': animal_name, 'date': date})
+    return sessions, probes_yml_dir
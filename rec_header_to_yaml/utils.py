@@ -2,9 +2,21 @@
 
 import os
 import io
+import re
+import struct
+import hashlib
 import xmltodict
-import json
+from collections import OrderedDict
+from xml.etree import ElementTree
 import yaml
+from .instrument import record_read, record_write
+from .archive import open_source, strip_compression, is_plain_file
+try:
+    # libyaml bindings (much faster); pure-Python classes as fallback
+    from yaml import CSafeLoader as YamlSafeLoader, CDumper as YamlCDumper
+except ImportError:
+    from yaml import SafeLoader as YamlSafeLoader
+    YamlCDumper = None
 
 # from rec_to_nwb.processing.header.xml_extractor import XMLExtractor
 
@@ -22,52 +34,92 @@ def _copy_into(file, source_file):
 
 # --- copy rec header to a separate (xml) file
 
-def read_rec_header(path, max_lines=1000, encoding='ISO-8859-1', stop_marker=None):
-    header = []
-    with io.open(path, 'r', encoding=encoding) as fh:
-        try:
-            cnt = 0
-            for line in fh:
-                header.append(line)
-                cnt = cnt + 1
-                stop = (cnt >= max_lines) or (stop_marker and stop_marker in line)
-                if stop:
-                    break
-        except Exception as e: # catch *all* exceptions
-            print('Error while reading line {}:'.format(cnt))
-            print(e)
-            fcopy.close()
-            return None
+HEADER_STOP_MARKER = b'</Configuration>'
+HEADER_CHUNK_SIZE = 64 * 1024 # bytes per read while looking for the stop marker
+HEADER_MAX_BYTES = 64 * 1024 * 1024 # give up if no marker within this range
+
+def locate_rec_header(path, stop_marker=HEADER_STOP_MARKER,
+                      chunk_size=HEADER_CHUNK_SIZE, max_bytes=HEADER_MAX_BYTES):
+    '''
+    find the end of the XML header in a .rec file by a byte search,
+    reading bounded binary chunks from the start of the file
+    (the rest of the file is packed binary data and is never touched).
+    path may also be a compressed .rec file or a member of an archive
+    (see archive.open_source); these are decompressed only this far.
+
+    returns (header_bytes, data_offset):
+    - header_bytes: raw bytes up to and including the line with stop_marker
+    - data_offset: byte offset where the binary data starts
+    '''
+    buf = bytearray()
+    with open_source(path) as fh:
+        while len(buf) < max_bytes:
+            chunk = fh.read(chunk_size)
+            if not chunk:
+                break
+            # only search the new chunk (plus overlap for a split marker)
+            search_from = max(0, len(buf) - len(stop_marker) + 1)
+            buf += chunk
+            pos = buf.find(stop_marker, search_from)
+            if pos < 0:
+                continue
+            end = pos + len(stop_marker)
+            # the header line ends with a newline (may need one more byte)
+            if end + 2 > len(buf):
+                buf += fh.read(2)
+            if buf[end:end + 2] == b'\r\n':
+                end += 2
+            elif buf[end:end + 1] == b'\n':
+                end += 1
+            record_read(len(buf))
+            return bytes(buf[:end]), end
+    record_read(len(buf))
+    raise ValueError('{} not found in the first {} bytes of {}'.format(
+        stop_marker.decode(), len(buf), path))
+
+# attributes that differ between recordings of the same configuration
+VOLATILE_HEADER_ATTRS = ['systemTimeAtCreation', 'timestampAtCreation',
+                         'filePrefix', 'filePath']
+_volatile_attr_pattern = re.compile(
+    rb'\s(?:' + b'|'.join(a.encode() for a in VOLATILE_HEADER_ATTRS) + rb')="[^"]*"')
+
+def normalize_header(header_bytes):
+    ''' drop per-recording attributes and line-ending differences '''
+    header_bytes = header_bytes.replace(b'\r\n', b'\n')
+    return _volatile_attr_pattern.sub(b'', header_bytes)
+
+def header_digest(header_bytes):
+    ''' content address of a header: same config, same digest '''
+    return hashlib.sha1(normalize_header(header_bytes)).hexdigest()
+
+def read_rec_header(path, max_lines=None, encoding='ISO-8859-1',
+                    stop_marker='</Configuration>'):
+    ''' returns the header as a list of lines (each including '\\n') '''
+    header_bytes, _ = locate_rec_header(path, stop_marker=stop_marker.encode(encoding))
+    header = header_bytes.decode(encoding).splitlines(keepends=True)
+    if max_lines is not None:
+        header = header[:max_lines]
     return header
 
 def _copy_header_lines(rec_path=None, copy_path=None, encoding='ISO-8859-1',
-                       stop_marker=None, max_lines=1000):
+                       stop_marker='</Configuration>', max_lines=None):
     if rec_path is None:
         raise ValueError('input path is required.')
     if copy_path is None:
         raise ValueError('output path is required.')
-    fcopy = io.open(copy_path, 'w', encoding=encoding)
-    with io.open(rec_path, 'r', encoding=encoding) as fh:
-        try:
-            cnt = 0
-            for line in fh:
-                fcopy.write(line)
-                cnt = cnt + 1
-                stop = (cnt >= max_lines) or (stop_marker and stop_marker in line)
-                if stop:
-                    break
-        except Exception as e: # catch *all* exceptions
-            print('Error while reading line {}:'.format(cnt))
-            print(e)
-            fcopy.close()
-            return None
-    fcopy.close()
-    return cnt
+    header_bytes, _ = locate_rec_header(rec_path,
+                                        stop_marker=stop_marker.encode(encoding))
+    if max_lines is not None:
+        header_bytes = b''.join(header_bytes.splitlines(keepends=True)[:max_lines])
+    with io.open(copy_path, 'wb') as fcopy:
+        fcopy.write(header_bytes)
+    record_write(len(header_bytes))
+    return header_bytes.count(b'\n')
 
-def copy_rec_header(rec_path, copy_dir, max_lines=1000, talkative=False):
+def copy_rec_header(rec_path, copy_dir, max_lines=None, talkative=False):
     # check input path
     rec_dir = os.path.dirname(rec_path)
-    rec_filename = os.path.basename(rec_path)
+    rec_filename = strip_compression(os.path.basename(rec_path)) # (x.rec.gz: x.rec)
     if rec_filename[-4:] != '.rec':
         raise ValueError('unknown file extension')
     if talkative:
@@ -79,7 +131,7 @@ def copy_rec_header(rec_path, copy_dir, max_lines=1000, talkative=False):
                              rec_filename + '_header' + '.xml' # .rec_header.xml
                             )
     
-    # copy line by line
+    # copy header bytes (up to the end of </Configuration>)
     cnt = _copy_header_lines(rec_path=rec_path,
                              copy_path=copy_path,
                              encoding='ISO-8859-1',
@@ -93,6 +145,7 @@ def copy_rec_header(rec_path, copy_dir, max_lines=1000, talkative=False):
     # temp_xml_extractor.extract_xml_from_rec_file()
     if talkative:
         print('Output file: {}'.format(copy_path))
+    return copy_path
 
 def write_xml_from_list(out_filename, header):
     ''' not needed '''
@@ -106,12 +159,247 @@ def read_xml(xml_path, attr_prefix='', unorder_dict=True):
     '''
     default attr_prefix for xmltodict is '@'
     '''
-    with open(xml_path) as fh:
-        ordered_dict = xmltodict.parse(fh.read(), attr_prefix=attr_prefix)
+    with open_source(xml_path) as fh: # (may be an archive member)
+        xml_bytes = fh.read()
+    record_read(len(xml_bytes))
+    return parse_xml_bytes(xml_bytes, attr_prefix=attr_prefix,
+                           unorder_dict=unorder_dict)
+
+def parse_xml_bytes(xml_bytes, attr_prefix='', unorder_dict=True):
+    ''' same as read_xml, for header contents already in memory '''
     if unorder_dict:
-        # convert to plain dict
-        return json.loads(json.dumps(ordered_dict))
-    return ordered_dict
+        # build plain dicts directly (no json round trip)
+        return xmltodict.parse(xml_bytes, attr_prefix=attr_prefix,
+                               dict_constructor=dict)
+    return xmltodict.parse(xml_bytes, attr_prefix=attr_prefix,
+                           dict_constructor=OrderedDict)
+
+# --- directory scan
+
+def iter_files(path):
+    '''
+    yield every file under path (recursive) as an os.DirEntry, in a single
+    os.scandir pass (entry.stat() is then a single, cached stat call);
+    directory symlinks are not followed, unreadable directories are skipped
+    '''
+    dirs = [path]
+    while dirs:
+        try:
+            it = os.scandir(dirs.pop())
+        except OSError: # gone, not a directory, no permission, ...
+            continue
+        record_read(0) # count directories opened
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False): # no symlink loops
+                    dirs.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+
+def scan_directory(path):
+    ''' list all files under path (recursive), in a single os.scandir pass '''
+    return [entry.path for entry in iter_files(path)]
+
+# --- streaming header parse (only the sections we need)
+
+def stream_header_sections(xml_source):
+    '''
+    iterparse the header and keep only compact records of the sections
+    used downstream; every element is dropped once it has been read,
+    so memory stays flat regardless of channel count.
+
+    xml_source: path to an xml file, or header bytes
+    returns a dict with
+    - 'ntrodes': list of (ntrode_id, hwChan list) tuples,
+                 hwChan list is None for an incomplete ntrode
+    - 'dio_channels': list of dicts for digital Device/Channel entries
+                 {'device', 'id', 'input', 'start_byte', 'bit'}
+    - 'hardware': HardwareConfiguration attributes for the packet layout
+                 {'sampling_rate', 'num_channels', 'sys_time_included',
+                  'devices': [(name, numBytes), ...]}
+    '''
+    if isinstance(xml_source, (bytes, bytearray)):
+        xml_source = io.BytesIO(xml_source)
+    elif not is_plain_file(xml_source):
+        with open_source(xml_source) as fh: # an archive member
+            xml_source = io.BytesIO(fh.read())
+        record_read(len(xml_source.getbuffer()))
+    else:
+        record_read(os.path.getsize(xml_source))
+    ntrodes = []
+    dio_channels = []
+    hardware = {'sampling_rate': None, 'num_channels': 0,
+                'sys_time_included': False, 'devices': []}
+    device = None
+    ntrode = None
+    stack = []
+    for event, elem in ElementTree.iterparse(xml_source, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            if elem.tag == 'SpikeNTrode':
+                ntrode = (int(elem.get('id')), [])
+            elif elem.tag == 'Device':
+                device = elem.get('name')
+                if elem.get('numBytes') is not None:
+                    hardware['devices'].append((device, int(elem.get('numBytes'))))
+            elif elem.tag == 'HardwareConfiguration':
+                read_hardware_attrs(hardware, elem.attrib)
+            continue
+
+        # event == 'end'
+        if elem.tag == 'SpikeChannel' and ntrode is not None:
+            hw_chan = elem.get('hwChan')
+            if hw_chan is None or ntrode[1] is None:
+                ntrode = (ntrode[0], None) # incomplete ntrode
+            else:
+                ntrode[1].append(int(hw_chan))
+        elif elem.tag == 'SpikeNTrode':
+            if ntrode[1] is not None and len(ntrode[1]) == 0:
+                ntrode = (ntrode[0], None) # no channels
+            ntrodes.append(ntrode)
+            ntrode = None
+        elif elem.tag == 'Channel' and device is not None:
+            if elem.get('dataType') == 'digital':
+                dio_channels.append({
+                    'device': device,
+                    'id': elem.get('id'),
+                    'input': elem.get('input') == '1',
+                    'start_byte': int(elem.get('startByte', 0)),
+                    'bit': int(elem.get('bit', 0))
+                    })
+        elif elem.tag == 'Device':
+            device = None
+
+        # drop the element from the tree
+        stack.pop()
+        elem.clear()
+        if stack:
+            stack[-1].remove(elem)
+    return {'ntrodes': ntrodes, 'dio_channels': dio_channels,
+            'hardware': hardware}
+
+def read_hardware_attrs(hardware, attrs):
+    if attrs.get('samplingRate') is not None:
+        hardware['sampling_rate'] = float(attrs['samplingRate'])
+    hardware['num_channels'] = int(attrs.get('numChannels', 0))
+    hardware['sys_time_included'] = attrs.get('sysTimeIncluded') == '1'
+
+# --- binary data layout
+
+def packet_layout(hardware):
+    '''
+    byte layout of one packet of .rec data (as in SpikeGadgets' readers):
+    sync byte, device bytes (in header order), [8-byte system time],
+    4-byte timestamp, then 2 bytes per ephys channel.
+    returns {'packet_size', 'timestamp_byte'}
+    '''
+    packet_size = 1
+    for _, num_bytes in hardware['devices']:
+        packet_size += num_bytes
+    if hardware['sys_time_included']:
+        packet_size += 8
+    timestamp_byte = packet_size
+    packet_size += 4
+    packet_size += 2 * hardware['num_channels']
+    return {'packet_size': packet_size, 'timestamp_byte': timestamp_byte}
+
+def read_timestamp(fh, offset):
+    fh.seek(offset)
+    raw = fh.read(4)
+    if len(raw) < 4:
+        return None
+    return struct.unpack('<I', raw)[0]
+
+def rec_data_summary(rec_path, data_offset, hardware):
+    '''
+    sample count and timestamp range of a .rec file, from its size and
+    two 4-byte reads (first and last packet); the data is not scanned.
+    '''
+    layout = packet_layout(hardware)
+    packet_size = layout['packet_size']
+    data_size = os.stat(rec_path).st_size - data_offset
+    num_samples = max(data_size, 0) // packet_size
+    summary = {
+        'num_samples': num_samples,
+        'trailing_bytes': max(data_size, 0) % packet_size,
+        'first_timestamp': None,
+        'last_timestamp': None,
+        'start_time': None,
+        'end_time': None,
+        'duration': None
+    }
+    if num_samples == 0:
+        return summary
+    with io.open(rec_path, 'rb') as fh:
+        first = read_timestamp(fh, data_offset + layout['timestamp_byte'])
+        last = read_timestamp(fh, data_offset + (num_samples - 1) * packet_size
+                                  + layout['timestamp_byte'])
+    record_read(8)
+    summary['first_timestamp'] = first
+    summary['last_timestamp'] = last
+    fs = hardware['sampling_rate']
+    if fs:
+        summary['start_time'] = first / fs
+        summary['end_time'] = last / fs
+        summary['duration'] = (last - first) / fs
+    return summary
+
+REC_SYNC_BYTE = 0x55 # first byte of every packet
+
+def validate_rec_data(rec_path, data_offset, hardware, num_checks=8):
+    '''
+    quick integrity check of a .rec file against its packet layout,
+    without reading the data:
+    - the data must be a whole number of packets (else: truncated copy)
+    - optionally, at num_checks strided packets (incl. first and last),
+      the sync byte must be 0x55 and the timestamps must increase
+    returns {'verdict': 'pass' | 'warn' | 'fail', 'messages': [...],
+             'num_samples', 'trailing_bytes'}
+    '''
+    layout = packet_layout(hardware)
+    packet_size = layout['packet_size']
+    data_size = os.stat(rec_path).st_size - data_offset
+    result = {'verdict': 'pass', 'messages': [],
+              'num_samples': max(data_size, 0) // packet_size,
+              'trailing_bytes': max(data_size, 0) % packet_size}
+
+    def report(verdict, message):
+        result['messages'].append(message)
+        if verdict == 'fail' or result['verdict'] == 'pass':
+            result['verdict'] = verdict
+
+    if result['num_samples'] == 0:
+        report('fail', 'no data after the header')
+        return result
+    if result['trailing_bytes'] != 0:
+        report('fail', 'data is not a whole number of {}-byte packets '
+               '({} bytes left over; truncated?)'.format(
+                packet_size, result['trailing_bytes']))
+    if num_checks < 2:
+        return result
+
+    num_samples = result['num_samples']
+    num_checks = min(num_checks, num_samples)
+    if num_checks < 2: # (a single packet: nothing to compare)
+        return result
+    indices = sorted(set([(num_samples - 1) * k // (num_checks - 1)
+                          for k in range(num_checks)]))
+    last_timestamp = None
+    with io.open(rec_path, 'rb') as fh:
+        for i in indices:
+            fh.seek(data_offset + i * packet_size)
+            sync = fh.read(1)
+            if sync != bytes([REC_SYNC_BYTE]):
+                report('warn', 'packet {}: unexpected sync byte {!r}'.format(i, sync))
+            timestamp = read_timestamp(fh, data_offset + i * packet_size
+                                           + layout['timestamp_byte'])
+            if (last_timestamp is not None) and (timestamp is not None) \
+                    and timestamp <= last_timestamp:
+                report('warn', 'packet {}: timestamp {} is not after {}'.format(
+                    i, timestamp, last_timestamp))
+            last_timestamp = timestamp
+    record_read(5 * len(indices))
+    return result
 
 # --- dict helpers
 
@@ -139,21 +427,112 @@ def float_representer(dumper, value):
     text = '{0:.3f}'.format(value)
     return dumper.represent_scalar(u'tag:yaml.org,2002:float', text)
 
-def write_yml(yml_path, data, access_mode='w', default_flow_style=False,
-sort_keys=False):
+def write_yml(yml_path, data, access_mode='w', **kwargs):
+    with io.open(yml_path, access_mode) as fh:
+        start = fh.tell()
+        dump_yml(fh, data, **kwargs)
+        record_write(fh.tell() - start)
+
+def dump_yml(fh, data, default_flow_style=False, sort_keys=False):
+    ''' write YAML to an open text stream (file or io.StringIO) '''
     # note: additional kwargs may not work in older versions of pyyaml
     # yaml.add_representer(float, float_representer)
-    with io.open(yml_path, access_mode) as fh:
-        yaml.dump(data, fh,
-                  Dumper=MyDumper,
-                  default_flow_style=default_flow_style,
-                  sort_keys=sort_keys)
-        
+    if (YamlCDumper is not None) and (not default_flow_style) \
+            and isinstance(data, (dict, list)) and _is_c_emitter_safe(data):
+        text = yaml.dump(data,
+                         Dumper=YamlCDumper,
+                         default_flow_style=default_flow_style,
+                         sort_keys=sort_keys)
+        fh.write(_indent_block_sequences(text))
+        return
+    yaml.dump(data, fh,
+              Dumper=MyDumper,
+              default_flow_style=default_flow_style,
+              sort_keys=sort_keys)
+
+_C_EMITTER_TYPES = (bool, int, float, type(None))
+_C_EMITTER_WIDTH = 80 # yaml's default best_width
+
+def _is_c_emitter_safe(data, depth=0):
+    '''
+    whether the libyaml output of data, re-indented by
+    _indent_block_sequences, is byte-identical to MyDumper's output:
+    only plain containers and scalars, and no string that could be
+    wrapped (or broken into lines) at a different column.
+    '''
+    if isinstance(data, _C_EMITTER_TYPES):
+        return True
+    if isinstance(data, str):
+        if not data or not data.isascii() or not data.isprintable():
+            return False
+        if ' ' not in data:
+            return True
+        # worst case: every level indented by 2 (+2 for the sequence dash)
+        return (4 * depth + len(data)) < (_C_EMITTER_WIDTH // 2)
+    if type(data) is dict:
+        # long keys are written as complex ('? key') keys
+        return all((not isinstance(k, str) or len(k) < 100)
+                   and _is_c_emitter_safe(k, depth + 1)
+                   and _is_c_emitter_safe(v, depth + 1)
+                   for k, v in data.items())
+    if type(data) is list:
+        return all(_is_c_emitter_safe(v, depth + 1) for v in data)
+    return False
+
+def _indent_block_sequences(text, indent=2):
+    '''
+    libyaml always writes block sequences inside a mapping "indentless":
+        key:
+        - item
+    MyDumper indents them (key:\n  - item). libyaml has no hook for
+    increase_indent, so shift every such sequence block afterwards.
+    '''
+    out = []
+    blocks = [] # stack of (column, shift) of open indentless sequences
+    prev_key_col = None # column of the key if the previous line was "key:"
+    for line in text.splitlines(keepends=True):
+        content = line.lstrip(' ')
+        col = len(line) - len(content)
+        is_item = content.startswith('- ') or content.rstrip('\n') == '-'
+        # close sequence blocks that ended
+        while blocks and (col < blocks[-1][0] or
+                          (col == blocks[-1][0] and not is_item)):
+            blocks.pop()
+        if is_item and col == prev_key_col and \
+                not (blocks and blocks[-1][0] == col):
+            blocks.append((col, indent))
+        shift = sum([b[1] for b in blocks])
+        out.append(' ' * shift + line)
+
+        # where would a key on this line start?
+        key_col = col
+        while content.startswith('- '):
+            content = content[2:]
+            key_col += 2
+        prev_key_col = key_col if content.rstrip('\n').endswith(':') else None
+    return ''.join(out)
+
 def append_yml(yml_path, data, **kwargs):
     write_yml(yml_path, data, access_mode='a', **kwargs)
-        
+
+def write_text_atomic(path, text):
+    '''
+    write text to a temporary file next to path, then rename it over path,
+    so readers never see a half-written file
+    '''
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with io.open(tmp_path, 'w') as fh:
+            fh.write(text)
+        record_write(len(text))
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
 def read_yml(yml_path):
+    record_read(os.path.getsize(yml_path))
     with io.open(yml_path, 'r') as fh:
         # data = yaml.load(fh, Loader=yaml.FullLoader)
-        data = yaml.safe_load(fh) # always use safe_load
+        data = yaml.load(fh, Loader=YamlSafeLoader) # always safe loading
     return data
@@ -0,0 +1,188 @@
+# watch.py
+# long-running watch over data_path: draft sessions once their
+# recordings have stopped growing
+
+import os
+import time
+import argparse
+from collections import OrderedDict
+
+from .batch import discover_sessions, build_drafts
+from .utils import read_yml, iter_files
+from .archive import ARCHIVE_SUFFIXES, strip_compression
+
+
+def session_signature(rec_path):
+    '''
+    (relative path, size, mtime_ns) of every file under rec_path, sorted;
+    only directory entries are stat'ed, no file is opened
+    '''
+    signature = []
+    for entry in iter_files(rec_path):
+        try:
+            st = entry.stat()
+        except OSError: # removed since it was listed (seen on the next poll)
+            continue
+        signature.append((os.path.relpath(entry.path, rec_path),
+                          st.st_size, st.st_mtime_ns))
+    return tuple(sorted(signature))
+
+
+class SessionWatcher():
+    '''
+    polls data_path for <animal>/raw/<date>/ sessions and drafts each
+    one (incrementally, see batch.build_drafts) once it has settled:
+    it has .rec files, and no file under it changed size or mtime for
+    settle_time seconds.
+
+    to keep polls cheap, a session's files are only stat'ed while it is
+    unsettled, or when its directory mtime changed (files added or
+    removed); every rescan_interval seconds (None: never) all sessions
+    are stat'ed again, to catch files that grew without the directory
+    changing.
+    at most max_queue settled sessions are drafted per poll; the rest
+    stay settled and are drafted on a later poll.
+    file system errors (e.g. a network mount briefly gone) are reported
+    and the session, or the whole poll, is retried on the next poll.
+    '''
+
+    def __init__(self, helper_kwargs, out_path='yaml/', animals=None,
+                 settle_time=60, max_queue=16, max_workers=1,
+                 rescan_interval=3600, talkative=True):
+        self.helper_kwargs = helper_kwargs
+        self.data_path = helper_kwargs['data_path']
+        self.out_path = out_path
+        self.animals = animals
+        self.settle_time = settle_time
+        self.max_queue = max_queue
+        self.max_workers = max_workers
+        self.rescan_interval = rescan_interval
+        self.talkative = talkative
+        # session_id -> {'session', 'rec_path', 'dir_mtime', 'signature',
+        #                'changed_at', 'drafted_signature'}
+        self.sessions = OrderedDict()
+        self._last_rescan = None
+
+    def _update(self, state, now, full_rescan):
+        try:
+            dir_mtime = os.stat(state['rec_path']).st_mtime_ns
+        except FileNotFoundError:
+            return
+        drafted = (state['drafted_signature'] is not None
+                   and state['drafted_signature'] == state['signature'])
+        if drafted and not full_rescan and dir_mtime == state['dir_mtime']:
+            return # nothing added or removed since the draft
+        state['dir_mtime'] = dir_mtime
+        signature = session_signature(state['rec_path'])
+        if state['signature'] is None and len(signature) > 0:
+            # first seen: settled since its newest file was last modified
+            state['changed_at'] = min(now, max(f[2] for f in signature) / 1e9)
+        elif signature != state['signature']:
+            state['changed_at'] = now
+        state['signature'] = signature
+
+    def is_settled(self, state, now):
+        if state['signature'] is None or state['signature'] == state['drafted_signature']:
+            return False
+        if not any(strip_compression(f[0]).endswith(('.rec',) + ARCHIVE_SUFFIXES)
+                   for f in state['signature']):
+            return False
+        return (now - state['changed_at']) >= self.settle_time
+
+    def poll(self, now=None):
+        '''
+        look for new and changed sessions;
+        returns the settled sessions to draft (at most max_queue)
+        '''
+        now = time.time() if now is None else now
+        full_rescan = (self.rescan_interval is not None
+                       and (self._last_rescan is None
+                            or now - self._last_rescan >= self.rescan_interval))
+        if full_rescan:
+            self._last_rescan = now
+        for session in discover_sessions(self.data_path, animals=self.animals):
+            session_id = '{}_{}'.format(session['animal_name'], session['date'])
+            if session_id not in self.sessions:
+                self.sessions[session_id] = {
+                    'session': session,
+                    'rec_path': os.path.join(self.data_path, session['animal_name'],
+                                             'raw', session['date']),
+                    'dir_mtime': None, 'signature': None, 'changed_at': None,
+                    'drafted_signature': None}
+            try:
+                self._update(self.sessions[session_id], now, full_rescan)
+            except OSError as e: # retried on the next poll
+                print('{}: cannot check files: {}'.format(session_id, e))
+        ready = [session_id for session_id, state in self.sessions.items()
+                 if self.is_settled(state, now)]
+        return ready[:self.max_queue]
+
+    def run_once(self, now=None):
+        ''' poll, then draft the settled sessions; returns their results '''
+        ready = self.poll(now=now)
+        if len(ready) == 0:
+            return []
+        results = build_drafts([self.sessions[session_id]['session'] for session_id in ready],
+                               self.helper_kwargs, out_path=self.out_path,
+                               max_workers=self.max_workers, incremental=True,
+                               talkative=self.talkative)
+        for session_id in ready:
+            state = self.sessions[session_id]
+            # failed sessions are retried only once their files change
+            state['drafted_signature'] = state['signature']
+        return results
+
+    def run(self, poll_interval=30, max_polls=None):
+        num_polls = 0
+        while max_polls is None or num_polls < max_polls:
+            try:
+                self.run_once()
+            except OSError as e: # e.g. data_path unavailable; keep watching
+                print('poll failed: {}'.format(e))
+            num_polls += 1
+            if max_polls is None or num_polls < max_polls:
+                time.sleep(poll_interval)
+
+
+# --- console entry point
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='watch data_path and draft sessions as recordings land.')
+    parser.add_argument('config',
+        help=('YAML file with the shared NWBMetadataHelper arguments '
+              '(data_path, dio_id, probes_used, probes_yml_dir, ...)'))
+    parser.add_argument('--data-path', help='overrides data_path in config')
+    parser.add_argument('--animal', action='append',
+        help='only watch sessions of this animal (repeatable)')
+    parser.add_argument('--out-path', default='yaml/')
+    parser.add_argument('--poll-interval', type=float, default=30,
+        help='seconds between polls (default: 30)')
+    parser.add_argument('--settle-time', type=float, default=60,
+        help='seconds without file changes before a session is drafted (default: 60)')
+    parser.add_argument('--max-queue', type=int, default=16,
+        help='most sessions drafted per poll (default: 16)')
+    parser.add_argument('--workers', type=int, default=1,
+        help='process pool size for drafting (default: 1)')
+    parser.add_argument('--rescan-interval', type=float, default=3600,
+        help='seconds between full rescans of all sessions (default: 3600)')
+    parser.add_argument('--max-polls', type=int, default=None,
+        help='stop after this many polls (default: run until interrupted)')
+    args = parser.parse_args(argv)
+
+    helper_kwargs = read_yml(args.config)
+    if args.data_path is not None:
+        helper_kwargs['data_path'] = args.data_path
+    watcher = SessionWatcher(helper_kwargs, out_path=args.out_path,
+                             animals=args.animal, settle_time=args.settle_time,
+                             max_queue=args.max_queue, max_workers=args.workers,
+                             rescan_interval=args.rescan_interval)
+    try:
+        watcher.run(poll_interval=args.poll_interval, max_polls=args.max_polls)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
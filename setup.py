@@ -8,5 +8,12 @@ setup(
     author_email='jihyun.bak@gmail.com',
     url='https://github.com/jihyunbak/rec_header_to_yaml',
     packages=find_packages(),
+    entry_points={
+        'console_scripts': [
+            'rec-header-to-yaml=rec_header_to_yaml.cli:main',
+            'rec-header-to-yaml-batch=rec_header_to_yaml.batch:main',
+            'rec-header-to-yaml-watch=rec_header_to_yaml.watch:main',
+        ],
+    },
 )
 